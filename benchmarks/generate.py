@@ -0,0 +1,82 @@
+'''
+Synthetic litematic generator, for benchmarking the conversion pipeline.
+Usage: python -m benchmarks.generate output.litematic --size 64 64 64 --palette-size 32 --air-ratio 0.5 --tile-entity-density 0.01
+'''
+
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Optional
+
+from litemapy import BlockState, Region, Schematic, TileEntity
+from nbtlib import Compound, Int, List, String
+import numpy as np
+
+from minecraft import load_asset_index
+from models.raw_models import palette_array
+
+# Used when there's no asset index to pick the block states from
+FALLBACK_BLOCK_STATES = [
+    ('minecraft:stone', {}), ('minecraft:dirt', {}), ('minecraft:granite', {}), ('minecraft:gravel', {}),
+    ('minecraft:spruce_planks', {}), ('minecraft:yellow_concrete', {}),
+]
+
+TILE_ENTITY_BLOCK = 'minecraft:chest'
+
+
+def available_block_states() -> list[tuple[str, dict[str, str]]]:
+    '''
+    The block states of the asset index's variants (multipart only blocks left out), or a few common full blocks without index
+    '''
+    index = load_asset_index()
+    if index is None:
+        return FALLBACK_BLOCK_STATES
+
+    return [(f'minecraft:{block_id}', properties) for block_id, block_state in sorted(index['blockstates'].items())
+            if f'minecraft:{block_id}' != TILE_ENTITY_BLOCK for properties, _ in block_state.get('variants', [])]
+
+
+def generate_schematic(size: tuple[int, int, int], palette_size: int, air_ratio: float, tile_entity_density: float,
+                       seed: Optional[int] = None) -> Schematic:
+    '''
+    A single region schematic of the given size, filled at random: air_ratio of air, then palette_size different block states,
+    tile_entity_density of the non-air blocks being chests (with their tile entity)
+    '''
+    rng = np.random.default_rng(seed)
+    block_states = available_block_states()
+    chosen = rng.choice(len(block_states), size=min(palette_size, len(block_states)), replace=False)
+
+    region = Region(0, 0, 0, *size)
+    # registers the palette entries: index 0 is air, then the chosen block states, then the chest
+    for palette_index, block_state_index in enumerate(chosen.tolist()):
+        block_id, properties = block_states[block_state_index]
+        region[palette_index % size[0], 0, 0] = BlockState(block_id, **properties)
+    region[0, 0, 0] = BlockState(TILE_ENTITY_BLOCK, facing='north', type='single', waterlogged='false')
+
+    blocks = rng.integers(1, len(chosen) + 1, size=size, dtype=np.uint32)
+    blocks[rng.random(size) < air_ratio] = 0
+
+    non_air = np.argwhere(blocks != 0)
+    tile_entity_positions = non_air[rng.random(len(non_air)) < tile_entity_density]
+    blocks[tuple(tile_entity_positions.T)] = len(chosen) + 1
+    for x, y, z in tile_entity_positions.tolist():
+        region.tile_entities.append(TileEntity(Compound({
+            'id': String(TILE_ENTITY_BLOCK), 'x': Int(x), 'y': Int(y), 'z': Int(z), 'Items': List[Compound](),
+        })))
+
+    palette_array(region)[...] = blocks
+
+    name = f'synthetic {size[0]}x{size[1]}x{size[2]}'
+    return Schematic(name=name, author='benchmarks', regions={'main': region})
+
+
+if __name__ == '__main__':
+    args = ArgumentParser()
+    args.add_argument('output', type=Path)
+    args.add_argument('--size', type=int, nargs=3, default=(64, 64, 64))
+    args.add_argument('--palette-size', type=int, default=32)
+    args.add_argument('--air-ratio', type=float, default=0.5)
+    args.add_argument('--tile-entity-density', type=float, default=0.0)
+    args.add_argument('--seed', type=int, default=None)
+    args = args.parse_args()
+
+    generate_schematic(tuple(args.size), args.palette_size, args.air_ratio, args.tile_entity_density, args.seed).save(str(args.output))
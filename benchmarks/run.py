@@ -0,0 +1,190 @@
+'''
+Times each stage of the conversion pipeline on synthetic (and optionally given) litematics, and writes the results as JSON.
+Usage: python -m benchmarks.run --sizes 16 32 64 --output benchmarks/results.json [--baseline previous_results.json]
+'''
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from gzip import GzipFile
+from io import BytesIO
+import json
+from pathlib import Path
+import platform
+from statistics import median
+import subprocess
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+import nbtlib
+
+import config
+from conversion import load_schematic
+import metrics
+import minecraft
+from minecraft import asset_index_version
+from models.culling import cull_hidden_geometry
+from models.output_models import OutputModel, OutputRegion
+from models.raw_models import RawTileEntity
+from result_cache import serialize_output
+
+from benchmarks.generate import generate_schematic
+
+# The pipeline's stages, one after the other: they add up to the conversion's time. The stages timed within them (see
+# metrics.stage) are reported as their parts, e.g. raw.resolve_models
+STAGES = ('parse', 'raw', 'cull', 'output', 'serialize')
+
+
+def clear_model_caches() -> None:
+    # Every run starts from cold caches, as a freshly started worker would
+    minecraft.resolved_models.clear()
+    for cached_function in (minecraft._get_block_state, minecraft._get_block_state_matcher, minecraft._get_model,
+                            minecraft._get_texture_url):
+        cached_function.cache_clear()
+
+
+def run_pipeline(data: bytes, measure: Callable[[str, Callable], object]) -> dict:
+    schematic = measure('parse', lambda: load_schematic(data))
+    regions = schematic.regions
+
+    # the models are resolved (from cold caches) while building the raw models, as in the server
+    raw_regions = measure('raw', lambda: {name: RawTileEntity.from_schematic_region(region) for name, region in regions.items()})
+    culled_regions = measure('cull', lambda: {name: cull_hidden_geometry(raw_region) for name, raw_region in raw_regions.items()})
+    output_regions = measure('output', lambda: {name: OutputRegion.from_raw_tile_entity(culled_region, config.GREEDY_MESHING)
+                                                for name, culled_region in culled_regions.items()})
+    output_model = OutputModel(author=schematic.author, name=schematic.name, regions=output_regions)
+    payloads = measure('serialize', lambda: serialize_output(output_model))
+
+    return {
+        'blocks': int(sum(len(raw_region.positions) for raw_region in raw_regions.values())),
+        'block_models': sum(len(output_region.blocks) for output_region in output_regions.values()),
+        'meshes': sum(len(output_region.meshes or []) for output_region in output_regions.values()),
+        'payload_bytes': {output_format: len(payload) for output_format, payload in payloads.items()},
+    }
+
+
+def benchmark(data: bytes, repeat: int) -> dict:
+    '''
+    Time the pipeline's stages and their parts (median of the runs), then measure each stage's peak memory in an extra run:
+    tracemalloc slows the code down too much to be on during the timed runs.
+    '''
+    timings: dict[str, list[float]] = {stage: [] for stage in STAGES}
+    part_timings: dict[str, list[float]] = {}
+
+    def timed(stage: str, function: Callable):
+        stage_metrics = metrics.Metrics()
+        start = time.perf_counter()
+        with metrics.collect(stage_metrics):
+            result = function()
+        timings[stage].append(time.perf_counter() - start)
+
+        for name, (_, seconds) in stage_metrics.stages.items():
+            # (the parse and serialize functions time themselves as a whole)
+            if name != stage:
+                part_timings.setdefault(f'{stage}.{name}', []).append(seconds)
+
+        return result
+
+    for _ in range(repeat):
+        clear_model_caches()
+        summary = run_pipeline(data, timed)
+
+    peak_memory: dict[str, int] = {}
+
+    def traced(stage: str, function: Callable):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        result = function()
+        peak_memory[stage] = tracemalloc.get_traced_memory()[1] - before
+        return result
+
+    clear_model_caches()
+    tracemalloc.start()
+    try:
+        run_pipeline(data, traced)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        **summary,
+        'stages': {stage: {'seconds': median(timings[stage]), 'runs': timings[stage], 'peak_memory_bytes': peak_memory[stage]}
+                   for stage in STAGES},
+        'stage_parts': {name: {'seconds': median(runs), 'runs': runs} for name, runs in part_timings.items()},
+        'total_seconds': sum(median(timings[stage]) for stage in STAGES),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results: dict, baseline: dict) -> None:
+    baseline_cases = {case['name']: case for case in baseline['cases']}
+    for case in results['cases']:
+        if case['name'] not in baseline_cases:
+            continue
+
+        print(case['name'])
+        baseline_stages = {**baseline_cases[case['name']]['stages'], **baseline_cases[case['name']].get('stage_parts', {})}
+        for stage, timing in {**case['stages'], **case['stage_parts']}.items():
+            if stage not in baseline_stages:
+                continue
+
+            seconds, baseline_seconds = timing['seconds'], baseline_stages[stage]['seconds']
+            ratio = seconds / baseline_seconds if baseline_seconds else float('inf')
+            print(f'  {stage:<20}{baseline_seconds:>10.4f}s -> {seconds:>10.4f}s  (x{ratio:.2f})')
+
+
+if __name__ == '__main__':
+    args = ArgumentParser()
+    args.add_argument('--sizes', type=int, nargs='*', default=[16, 32, 64], help='edge length of the synthetic (cubic) schematics')
+    args.add_argument('--palette-size', type=int, default=32)
+    args.add_argument('--air-ratio', type=float, default=0.5)
+    args.add_argument('--tile-entity-density', type=float, default=0.01)
+    args.add_argument('--seed', type=int, default=0)
+    args.add_argument('--schematics', type=Path, nargs='*', default=[], help='litematic files to benchmark as well')
+    args.add_argument('--repeat', type=int, default=3)
+    args.add_argument('--output', type=Path, default=Path(__file__).parent.joinpath('results.json'))
+    args.add_argument('--baseline', type=Path, default=None, help='previous results to compare with')
+    args = args.parse_args()
+
+    cases = []
+    for size in args.sizes:
+        parameters = {'size': size, 'palette_size': args.palette_size, 'air_ratio': args.air_ratio,
+                      'tile_entity_density': args.tile_entity_density, 'seed': args.seed}
+        schematic = generate_schematic((size, size, size), args.palette_size, args.air_ratio, args.tile_entity_density, args.seed)
+
+        # same bytes as a litematic file, so that the parsing is measured too
+        data = BytesIO()
+        with GzipFile(fileobj=data, mode='wb') as compressed:
+            nbtlib.File(schematic.to_nbt()).write(compressed)
+        name = f'synthetic-{size}-p{args.palette_size}-a{args.air_ratio}-t{args.tile_entity_density}'
+        cases.append({'name': name, 'parameters': parameters, 'file_bytes': data.tell(), 'data': data.getvalue()})
+
+    for path in args.schematics:
+        data = path.read_bytes()
+        cases.append({'name': path.name, 'parameters': {'path': str(path)}, 'file_bytes': len(data), 'data': data})
+
+    results = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'git_commit': git_commit(),
+        'asset_index_version': asset_index_version(),
+        'greedy_meshing': config.GREEDY_MESHING,
+        'repeat': args.repeat,
+        'cases': [],
+    }
+    for case in cases:
+        data = case.pop('data')
+        results['cases'].append({**case, **benchmark(data, args.repeat)})
+        print(f"{case['name']}: {results['cases'][-1]['total_seconds']:.3f}s")
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(results, indent=2))
+
+    if args.baseline is not None:
+        print_comparison(results, json.loads(args.baseline.read_text()))
@@ -1 +1,100 @@
+import os
+from pathlib import Path
+
 TEXTURES_BASE_URL = 'textures'
+
+# Directory of the resources extracted from the client jar files (see extract_resources.py)
+CLIENT_ASSETS_ROOT = Path(__file__).parent.parent.joinpath('static', 'client_assets')
+
+# Client version whose resources are served, extracted side by side with the others with extract_resources.py's --version
+# (None: the resources extracted without any version, right within CLIENT_ASSETS_ROOT)
+ASSETS_VERSION = os.environ.get('ASSETS_VERSION') or None
+
+# Root of the resources served
+CLIENT_ASSETS_PATH = CLIENT_ASSETS_ROOT.joinpath(ASSETS_VERSION) if ASSETS_VERSION else CLIENT_ASSETS_ROOT
+
+# Compiled asset index, written within CLIENT_ASSETS_PATH at extraction time
+ASSET_INDEX_FILE = 'index.json'
+
+# Jar entries (with their CRC and size) of the extracted resources, written within CLIENT_ASSETS_PATH to only extract the changes
+EXTRACT_MANIFEST_FILE = 'manifest.json'
+
+# Number of threads writing the extracted resources
+EXTRACT_WORKERS = 8
+
+# Maximum number of resolved block state models kept in memory
+MODEL_CACHE_SIZE = 4096
+
+# Maximum number of block state definitions, block models and texture URLs each kept in memory (the asset set has a few
+# thousands of each)
+ASSET_CACHE_SIZE = 4096
+
+# Full cube blocks which still let their neighbors be seen through (matched as block id substrings)
+TRANSPARENT_BLOCKS = ('glass', 'leaves', 'minecraft:ice', 'frosted_ice', 'slime_block', 'honey_block', 'spawner', 'barrier')
+
+# Number of worker processes converting the schematics (None: one per CPU)
+CONVERSION_WORKERS = None
+
+# Seconds convert_schematics.py lets a single file convert before giving up on it (None: no limit)
+CONVERSION_FILE_TIMEOUT = 300
+
+# Maximum number of conversion jobs (and results) kept in memory
+MAX_CONVERSION_JOBS = 256
+
+# On-disk store of the converted schematics, keyed by content
+RESULT_CACHE_PATH = Path(__file__).parent.parent.joinpath('cache', 'results')
+
+# Maximum number of converted payloads kept in memory (each converted schematic has one per output format)
+RESULT_CACHE_SIZE = 128
+
+# Edge length, in blocks, of the chunks the streamed conversions are split into
+STREAM_CHUNK_SIZE = 16
+
+# Maximum number of converted chunks waiting to be sent, per streamed conversion
+STREAM_QUEUE_SIZE = 8
+
+# Number of worker processes dedicated to the streamed conversions
+STREAM_WORKERS = 2
+
+# Seconds a streamed conversion waits for its client to read the next chunk before giving up
+STREAM_STALL_TIMEOUT = 30
+
+# Directory of the texture atlas pages, within the extracted textures
+ATLAS_DIR = '_atlas'
+
+# Edge length, in pixels, of the texture atlas pages
+ATLAS_PAGE_SIZE = 1024
+
+# Pixels repeated around each texture of the atlas, against the neighbor textures bleeding in
+ATLAS_PADDING = 1
+
+# Textures packed into the atlas (matched as texture path prefixes)
+ATLAS_TEXTURES = ('block/',)
+
+# Merge the faces of the full cubes into per texture meshes (when they're smaller than the cubes' instances), instead of drawing
+# each cube on its own. Off until the meshes are a net win on real builds.
+GREEDY_MESHING = False
+
+# On-disk store of the uploaded schematics, keyed by content, for their partial conversions
+SOURCE_CACHE_PATH = Path(__file__).parent.parent.joinpath('cache', 'sources')
+
+# Edge length, in blocks, of the chunk grid indexing the schematics for the spatial queries
+SPATIAL_CHUNK_SIZE = 16
+
+# Maximum number of parsed and indexed schematics kept in memory, per worker process
+INDEXED_SCHEMATICS_CACHE_SIZE = 8
+
+# Downsampling factors (blocks per cell edge) of the low detail levels sent first by the streamed conversions
+LOD_FACTORS = (2, 4)
+
+# rgb color of the low detail cells made of blocks with no known texture color
+LOD_DEFAULT_COLOR = (128, 128, 128)
+
+# Send the stage timings of each request back as a Server-Timing header
+SERVER_TIMING = True
+
+# Allow profiling the conversions of the requests with a "profile" query parameter (never on a public server)
+PROFILING = False
+
+# Where the conversion profiles are written, as cProfile .prof files
+PROFILES_PATH = Path(__file__).parent.parent.joinpath('cache', 'profiles')
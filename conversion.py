@@ -0,0 +1,386 @@
+'''
+Runs the CPU bound schematic conversions on a pool of worker processes, keeping the server's event loop free
+'''
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from gzip import GzipFile
+from hashlib import sha256
+from io import BytesIO
+import json
+from multiprocessing import Manager
+from multiprocessing.managers import SyncManager
+from pathlib import Path
+from queue import Empty, Full, Queue
+from threading import Event
+import time
+from typing import AsyncIterator, Callable, Iterator, Literal, Optional
+
+from litemapy import Region, Schematic
+import nbtlib
+from pydantic import TypeAdapter
+from pydantic.dataclasses import dataclass
+
+from bounded_cache import BoundedCache
+import config
+import metrics
+from metrics import profiling_requested, record, run_with_metrics
+from minecraft import load_asset_index
+from models.culling import cull_hidden_geometry
+from models.lod import build_lod_levels, palette_colors
+from models.output_models import OutputChunk, OutputLodChunk, OutputModel, OutputRegion, OutputStreamHeader
+from models.raw_models import RawTileEntity, RegionBox
+from models.tile_entities import TileEntityIndex
+from result_cache import OutputFormat, ResultCache, serialize_output
+from spatial_index import IndexedSchematic, SpatialQuery
+
+
+def read_schematic_nbt(data: bytes) -> nbtlib.File:
+    # Only decodes the NBT: building the regions' blocks (Region.from_nbt) is what takes most of the parsing time
+    return nbtlib.File.parse(GzipFile(fileobj=BytesIO(data)))
+
+
+def load_schematic(data: bytes) -> Schematic:
+    with metrics.stage('parse'):
+        return Schematic.from_nbt(read_schematic_nbt(data))
+
+
+def read_schematic_header(data: bytes) -> tuple[str, str, list[str]]:
+    '''
+    The schematic's author, name and region names, without building any of its regions
+    '''
+    with metrics.stage('parse'):
+        nbt = read_schematic_nbt(data)
+
+    return str(nbt['Metadata']['Author']), str(nbt['Metadata']['Name']), [str(region_name) for region_name in nbt['Regions'].keys()]
+
+
+def load_region(data: bytes, region_name: str) -> Region:
+    '''
+    Build only one of the schematic's regions
+    '''
+    with metrics.stage('parse'):
+        return Region.from_nbt(read_schematic_nbt(data)['Regions'][region_name])
+
+
+def convert_box(region: Region, box: Optional[RegionBox] = None, tile_entities: Optional[TileEntityIndex] = None,
+                outside_occludes: bool = True) -> OutputRegion:
+    '''
+    Convert the whole region, or only the blocks within the box (see RawTileEntity.from_schematic_region)
+    '''
+    with metrics.stage('raw'):
+        raw_tile_entity = RawTileEntity.from_schematic_region(region, box, tile_entities, outside_occludes)
+    with metrics.stage('cull'):
+        raw_tile_entity = cull_hidden_geometry(raw_tile_entity)
+    with metrics.stage('output'):
+        return OutputRegion.from_raw_tile_entity(raw_tile_entity, config.GREEDY_MESHING)
+
+
+def convert_region(data: bytes, region_name: str) -> OutputRegion:
+    return convert_box(load_region(data, region_name))
+
+
+def convert_schematic(data: bytes) -> OutputModel:
+    '''
+    Convert all the regions of the schematic within the current process
+    '''
+    schematic = load_schematic(data)
+
+    return OutputModel(author=schematic.author, name=schematic.name,
+                       regions={region_name: convert_box(region) for region_name, region in schematic.regions.items()})
+
+
+def serialized(function: Callable, *args) -> dict[OutputFormat, bytes]:
+    '''
+    Worker side: the serialized output model of the conversion, so that the server process only handles bytes
+    '''
+    return serialize_output(function(*args))
+
+
+indexed_schematics: BoundedCache[str, IndexedSchematic] = BoundedCache(config.INDEXED_SCHEMATICS_CACHE_SIZE)
+
+
+def load_indexed_schematic(key: str, data: bytes) -> IndexedSchematic:
+    '''
+    The parsed schematic with its spatial index, built on the first query and then kept by the worker
+    '''
+    indexed_schematic = indexed_schematics.get(key)
+    if indexed_schematic is None:
+        indexed_schematic = IndexedSchematic.from_schematic(load_schematic(data), config.SPATIAL_CHUNK_SIZE)
+        indexed_schematics.put(key, indexed_schematic)
+
+    return indexed_schematic
+
+
+def convert_query(key: str, data: bytes, query: SpatialQuery) -> OutputModel:
+    '''
+    Convert only the part of the schematic the query asks for
+    '''
+    indexed_schematic = load_indexed_schematic(key, data)
+    schematic = indexed_schematic.schematic
+
+    regions = {}
+    for region_name, box in indexed_schematic.query_boxes(query).items():
+        if box is None:
+            regions[region_name] = OutputRegion(textures={}, blocks=[])
+            continue
+
+        # the blocks left out of the query are not rendered, so they don't hide anything
+        tile_entities = indexed_schematic.tile_entities[region_name]
+        regions[region_name] = convert_box(schematic.regions[region_name], box, tile_entities, outside_occludes=False)
+
+    return OutputModel(author=schematic.author, name=schematic.name, regions=regions)
+
+
+def chunk_origin(region: Region, box: RegionBox) -> tuple[int, int, int]:
+    return region.min_x() + box[0][0], region.min_y() + box[0][1], region.min_z() + box[0][2]
+
+
+def iter_schematic_chunks(data: bytes, chunk_size: int) -> Iterator[bytes]:
+    '''
+    Convert a schematic one chunk at a time, as NDJSON lines: an OutputStreamHeader line, one OutputLodChunk line per non-empty chunk
+    (when LOD_FACTORS are set), then one OutputChunk line per non-empty chunk
+    '''
+    schematic = load_schematic(data)
+    yield TypeAdapter(OutputStreamHeader).dump_json(
+        OutputStreamHeader(author=schematic.author, name=schematic.name, regions=list(schematic.regions.keys()))) + b'\n'
+
+    # The low detail levels of the whole schematic come first, they're much faster to build and to render
+    if config.LOD_FACTORS:
+        lod_chunk_adapter = TypeAdapter(OutputLodChunk)
+        for region_name, region in schematic.regions.items():
+            colors = palette_colors(region)
+            for box in RawTileEntity.iter_chunk_boxes(region, chunk_size):
+                with metrics.stage('lod'):
+                    lod_levels = build_lod_levels(region, box, colors)
+                lod_chunk = OutputLodChunk.from_raw_lod_levels(region_name, chunk_origin(region, box), lod_levels)
+                yield lod_chunk_adapter.dump_json(lod_chunk) + b'\n'
+
+    chunk_adapter = TypeAdapter(OutputChunk)
+    for region_name, region in schematic.regions.items():
+        tile_entities = TileEntityIndex.from_region(region)
+        for box in RawTileEntity.iter_chunk_boxes(region, chunk_size):
+            output_region = convert_box(region, box, tile_entities)
+            # Chunks without any visible geometry are still sent when their low detail levels were, to replace them
+            if not output_region.blocks and not output_region.meshes and not config.LOD_FACTORS:
+                continue
+
+            chunk = OutputChunk(region=region_name, origin=chunk_origin(region, box), textures=output_region.textures,
+                                blocks=output_region.blocks, atlas=output_region.atlas, meshes=output_region.meshes)
+            yield chunk_adapter.dump_json(chunk, exclude_none=True) + b'\n'
+
+
+StreamStatus = Literal['done', 'failed', 'cancelled', 'stalled']
+
+
+def stream_schematic_chunks(data: bytes, chunk_size: int, lines: Queue, cancelled: Event) -> StreamStatus:
+    '''
+    Worker side of the streaming: push the NDJSON lines to the (bounded) queue, then None. Stops when the stream is cancelled,
+    or when its client didn't read anything for STREAM_STALL_TIMEOUT seconds, so that slow clients don't hold the worker.
+    '''
+    def put(line: Optional[bytes]) -> Optional[StreamStatus]:
+        deadline = time.monotonic() + config.STREAM_STALL_TIMEOUT
+        while not cancelled.is_set():
+            try:
+                lines.put(line, timeout=1)
+                return None
+            except Full:
+                if time.monotonic() > deadline:
+                    return 'stalled'
+        return 'cancelled'
+
+    status: StreamStatus = 'done'
+    try:
+        for line in iter_schematic_chunks(data, chunk_size):
+            if (stopped := put(line)) is not None:
+                return stopped
+    except Exception as e:
+        status = 'failed'
+        if (stopped := put(json.dumps({'error': str(e)}).encode() + b'\n')) is not None:
+            return stopped
+
+    return put(None) or status
+
+
+@dataclass
+class ConversionJob:
+    id: str
+    status: Literal['queued', 'running', 'done', 'failed']
+    regions_total: Optional[int] = None
+    regions_done: int = 0
+    error: Optional[str] = None
+
+
+class ConversionJobs:
+    '''
+    Schematic conversions, one worker process task per region, tracked as jobs
+    '''
+
+    def __init__(self, max_workers: Optional[int], max_stream_workers: int, max_jobs: int, result_cache: ResultCache):
+        self.max_workers = max_workers
+        self.max_stream_workers = max_stream_workers
+        self.max_jobs = max_jobs
+        self.result_cache = result_cache
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._stream_executor: Optional[ProcessPoolExecutor] = None
+        self._manager: Optional[SyncManager] = None
+        self._jobs: OrderedDict[str, ConversionJob] = OrderedDict()
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def start(self) -> None:
+        # Each worker loads the asset index once, when it starts
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=load_asset_index)
+        # The streams run on their own workers: their clients' reading pace never holds the jobs back
+        self._stream_executor = ProcessPoolExecutor(max_workers=self.max_stream_workers, initializer=load_asset_index)
+        # Provides the queues the streamed chunks go through
+        self._manager = Manager()
+
+    def shutdown(self) -> None:
+        for task in self._tasks.values():
+            task.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._stream_executor.shutdown(wait=False, cancel_futures=True)
+        self._manager.shutdown()
+
+    async def _run_on_worker(self, function: Callable, *args):
+        '''
+        Run the function on a worker process, then merge the metrics it collected into the current ones
+        '''
+        result, worker_metrics = await asyncio.get_running_loop().run_in_executor(
+            self._executor, run_with_metrics, profiling_requested(), function, *args)
+        record(worker_metrics)
+
+        return result
+
+    async def convert(self, data: bytes, job: Optional[ConversionJob] = None) -> dict[OutputFormat, bytes]:
+        '''
+        Convert a litematic, its regions in parallel, into the serialized output model.
+        The serialization happens on the workers too: it would hold the event loop for as long as it takes.
+        '''
+        author, name, region_names = await self._run_on_worker(read_schematic_header, data)
+
+        if job is not None:
+            job.status = 'running'
+            job.regions_total = len(region_names)
+
+        if len(region_names) == 1:
+            payloads = await self._run_on_worker(serialized, convert_schematic, data)
+            if job is not None:
+                job.regions_done += 1
+            return payloads
+
+        async def convert_job_region(region_name: str) -> OutputRegion:
+            region = await self._run_on_worker(convert_region, data, region_name)
+            if job is not None:
+                job.regions_done += 1
+            return region
+
+        regions = await asyncio.gather(*(convert_job_region(region_name) for region_name in region_names))
+
+        output_model = OutputModel(author=author, name=name, regions=dict(zip(region_names, regions)))
+
+        return await self._run_on_worker(serialize_output, output_model)
+
+    async def stream(self, data: bytes, key: str, chunk_size: int, queue_size: int) -> AsyncIterator[bytes]:
+        '''
+        Convert a litematic (identified by its content key) on a stream worker process, yielding its NDJSON lines while the
+        conversion is still running. At most queue_size lines are waiting to be sent at any time.
+        Completed streams are cached: the same content is then streamed from the cache, without converting it again.
+        '''
+        stream_key = sha256(f'{key}:stream:{chunk_size}:{config.LOD_FACTORS}'.encode()).hexdigest()
+        if (cached := await asyncio.to_thread(self.result_cache.get, stream_key, 'ndjson')) is not None:
+            yield cached
+            return
+
+        lines = self._manager.Queue(queue_size)
+        cancelled = self._manager.Event()
+        worker = asyncio.get_running_loop().run_in_executor(
+            self._stream_executor, run_with_metrics, profiling_requested(), stream_schematic_chunks, data, chunk_size, lines, cancelled)
+
+        async def next_line() -> Optional[bytes]:
+            # only the blocking queue read runs on a thread: the worker's future is checked on the event loop
+            while True:
+                try:
+                    return await asyncio.to_thread(lines.get, timeout=1)
+                except Empty:
+                    if worker.done():
+                        worker.result()
+                        return None
+
+        # the lines are written to the cache directory as they're sent, then moved into the cache once the stream is complete
+        spool = await asyncio.to_thread(self.result_cache.temp_file, stream_key, 'ndjson')
+        try:
+            try:
+                while (line := await next_line()) is not None:
+                    await asyncio.to_thread(spool.write, line)
+                    yield line
+
+                status, worker_metrics = await worker
+                record(worker_metrics)
+            finally:
+                cancelled.set()
+                spool.close()
+
+            if status == 'done':
+                await asyncio.to_thread(self.result_cache.put_file, stream_key, 'ndjson', Path(spool.name))
+        finally:
+            # failed, cancelled or disconnected streams leave nothing behind
+            Path(spool.name).unlink(missing_ok=True)
+
+        if status == 'stalled':
+            yield json.dumps({'error': f'Stream stalled for more than {config.STREAM_STALL_TIMEOUT}s'}).encode() + b'\n'
+
+    async def query(self, key: str, data: bytes, query: SpatialQuery) -> str:
+        '''
+        Convert the part of a litematic (identified by its content key) the query asks for, unless already cached.
+        Returns the result's cache key.
+        '''
+        result_key = sha256(f'{key}:{query.cache_key()}'.encode()).hexdigest()
+
+        if not self.result_cache.contains(result_key):
+            payloads = await self._run_on_worker(serialized, convert_query, key, data, query)
+            await asyncio.to_thread(self.result_cache.put, result_key, payloads)
+
+        return result_key
+
+    async def _run(self, job: ConversionJob, data: bytes) -> None:
+        try:
+            payloads = await self.convert(data, job)
+            await asyncio.to_thread(self.result_cache.put, job.id, payloads)
+            job.status = 'done'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            del self._tasks[job.id]
+
+    def submit(self, data: bytes, key: str) -> ConversionJob:
+        '''
+        Queue the conversion of a litematic, identified by its content key. Known contents are not converted twice.
+        '''
+        if key in self._jobs and self._jobs[key].status != 'failed':
+            return self._jobs[key]
+
+        if self.result_cache.contains(key):
+            return ConversionJob(id=key, status='done')
+
+        job = ConversionJob(id=key, status='queued')
+        self._jobs[job.id] = job
+        self._tasks[job.id] = asyncio.create_task(self._run(job, data))
+
+        # Forget the oldest finished jobs, their results stay in the cache
+        for job_id in [job_id for job_id in self._jobs if job_id not in self._tasks][:max(0, len(self._jobs) - self.max_jobs)]:
+            del self._jobs[job_id]
+
+        return job
+
+    async def wait(self, job_id: str) -> None:
+        if job_id in self._tasks:
+            await asyncio.shield(self._tasks[job_id])
+
+    def get(self, job_id: str) -> Optional[ConversionJob]:
+        if job_id not in self._jobs and self.result_cache.contains(job_id):
+            return ConversionJob(id=job_id, status='done')
+
+        return self._jobs.get(job_id, None)
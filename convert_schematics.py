@@ -0,0 +1,159 @@
+'''
+Convert a whole directory of litematics ahead of time, on a pool of worker processes.
+The results are written by content key, in the result cache layout (see result_cache.py): the server serves them right away
+(see /jobs/{key}/result), as would any static file server.
+Usage: python convert_schematics.py path/to/schematics [--output cache/results] [--formats json bin] [--report report.json]
+'''
+
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import time
+from typing import Optional
+
+import config
+from conversion import convert_schematic
+from metrics import run_with_metrics
+from minecraft import load_asset_index
+from result_cache import OUTPUT_MEDIA_TYPES, ResultCache, content_key, serialize_output
+
+
+def convert_file(path: Path, output_path: Path, output_formats: tuple[str, ...], force: bool) -> dict:
+    '''
+    Worker side: convert a litematic file unless its results already exist. Failures are reported, not raised.
+    '''
+    start = time.perf_counter()
+    report = {'path': str(path), 'key': None, 'status': 'converted', 'error': None}
+
+    try:
+        data = path.read_bytes()
+        report['key'] = key = content_key(data)
+        results = ResultCache(output_path, 0)
+
+        if not force and results.contains(key, output_formats):
+            report['status'] = 'skipped'
+        else:
+            results.put(key, serialize_output(convert_schematic(data), output_formats))
+    except Exception as e:
+        report['status'] = 'failed'
+        report['error'] = f'{type(e).__name__}: {e}'
+
+    report['seconds'] = time.perf_counter() - start
+
+    return report
+
+
+def failed_report(path: Path, error: str, start: float) -> dict:
+    return {'path': str(path), 'key': None, 'status': 'failed', 'error': error, 'seconds': time.perf_counter() - start, 'stages': {}}
+
+
+def file_report(future: Future, path: Path, start: float) -> dict:
+    try:
+        report, file_metrics = future.result()
+    except Exception as e:
+        return failed_report(path, f'{type(e).__name__}: {e}', start)
+
+    report['stages'] = file_metrics.snapshot()['stages']
+
+    return report
+
+
+def convert_directory(input_path: Path, output_path: Path, output_formats: tuple[str, ...], pattern: str, workers: Optional[int],
+                      force: bool = False, timeout: Optional[float] = config.CONVERSION_FILE_TIMEOUT) -> list[dict]:
+    '''
+    Convert every litematic of the directory (and its sub-directories), printing each file's outcome as it completes.
+    A file taking longer than the timeout, or whose worker process dies again when converted alone, is reported as failed: the
+    pool is then started again for the other files.
+    '''
+    paths = sorted(input_path.rglob(pattern))
+    pending = deque(paths)
+    # The files which were converting when a worker process died: any of them may be the culprit, so each gets a second chance
+    crashed: set[Path] = set()
+    reports = []
+
+    def add_report(report: dict) -> None:
+        reports.append(report)
+        outcome = report['error'] if report['status'] == 'failed' else report['key']
+        print(f"[{len(reports)}/{len(paths)}] {report['status']:<9} {report['seconds']:8.3f}s  {report['path']}  {outcome}")
+
+    while pending:
+        # Each worker loads the asset index once, when it starts
+        with ProcessPoolExecutor(max_workers=workers, initializer=load_asset_index) as executor:
+            # future: (path, submission time). No more files than workers are submitted, so that their time runs from their start
+            running: dict[Future, tuple[Path, float]] = {}
+
+            while pending or running:
+                while pending and len(running) < (workers or os.cpu_count() or 1):
+                    # The files given a second chance are converted alone, to tell which one kills its worker
+                    if running and (pending[0] in crashed or any(path in crashed for path, _ in running.values())):
+                        break
+                    path = pending.popleft()
+                    future = executor.submit(run_with_metrics, False, convert_file, path, output_path, output_formats, force)
+                    running[future] = (path, time.perf_counter())
+
+                first_start = min(start for _, start in running.values())
+                done, _ = wait(running, None if timeout is None else max(0.0, first_start + timeout - time.perf_counter()), FIRST_COMPLETED)
+
+                timed_out = False
+                for future, (path, start) in list(running.items()):
+                    if not done and time.perf_counter() - start >= timeout:
+                        del running[future]
+                        add_report(failed_report(path, f'TimeoutError: not converted within {timeout}s', start))
+                        timed_out = True
+
+                if timed_out:
+                    # A started conversion can't be cancelled: the workers are stopped instead, which breaks the pool
+                    for process in multiprocessing.active_children():
+                        process.terminate()
+
+                if timed_out or any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                    # The other conversions of the pool are lost as well (except the ones which completed in the meantime)
+                    wait(running)
+                    for future, (path, start) in running.items():
+                        if not isinstance(future.exception(), BrokenProcessPool):
+                            add_report(file_report(future, path, start))
+                        elif timed_out or path not in crashed:
+                            if not timed_out:
+                                crashed.add(path)
+                            pending.appendleft(path)
+                        else:
+                            add_report(failed_report(path, 'BrokenProcessPool: its worker process died', start))
+                    break
+
+                for future in done:
+                    add_report(file_report(future, *running.pop(future)))
+
+    return sorted(reports, key=lambda report: report['path'])
+
+
+if __name__ == '__main__':
+    args = ArgumentParser()
+    args.add_argument('input', type=Path, help='directory of the litematics to convert')
+    args.add_argument('--output', type=Path, default=config.RESULT_CACHE_PATH)
+    args.add_argument('--formats', nargs='+', choices=list(OUTPUT_MEDIA_TYPES), default=list(OUTPUT_MEDIA_TYPES),
+                      help='output formats to write (the server only uses results written in all of them)')
+    args.add_argument('--pattern', type=str, default='*.litematic')
+    args.add_argument('--workers', type=int, default=config.CONVERSION_WORKERS)
+    args.add_argument('--force', action='store_true', help='convert the files whose results already exist as well')
+    args.add_argument('--report', type=Path, default=None, help='write the per file outcomes and timings to this JSON file')
+    args.add_argument('--timeout', type=float, default=config.CONVERSION_FILE_TIMEOUT, help='seconds allowed to convert each file')
+    args = args.parse_args()
+
+    start = time.perf_counter()
+    reports = convert_directory(args.input, args.output, tuple(args.formats), args.pattern, args.workers, args.force,
+                                args.timeout)
+
+    statuses = [report['status'] for report in reports]
+    print(f"{statuses.count('converted')} converted, {statuses.count('skipped')} skipped, {statuses.count('failed')} failed "
+          f"in {time.perf_counter() - start:.1f}s")
+
+    if args.report is not None:
+        args.report.write_text(json.dumps(reports, indent=2))
+
+    if 'failed' in statuses:
+        exit(1)
@@ -1,33 +1,103 @@
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import json
 from pathlib import Path
 import shutil
-from zipfile import ZipFile
-from argparse import ArgumentParser
+from typing import Optional
+from zipfile import ZipFile, ZipInfo
+
+import config
+from minecraft import asset_index_outdated, write_asset_index
 
 '''
 Extract the textures from a minecraft client JAR file.
-Outputs to the static/textures/ directory
+Outputs to the static/client_assets/ directory (or to its version sub-directory, see config.ASSETS_VERSION), along with the
+compiled asset index. Only the entries changed since the last extraction are written again.
 '''
 
-args = ArgumentParser()
-args.add_argument('input', type=str)
-args = args.parse_args()
+# jar entries prefix: output directory
+JAR_DIRECTORIES = {
+    'assets/minecraft/textures/': 'textures',
+    'assets/minecraft/blockstates/': 'blockstates',
+    'assets/minecraft/models/': 'models',
+}
+
+
+def output_file(entry_name: str) -> Optional[str]:
+    '''
+    Path of the jar entry's extracted file, relative to the output directory (None when not extracted)
+    '''
+    for jar_prefix, directory in JAR_DIRECTORIES.items():
+        if entry_name.startswith(jar_prefix):
+            return f'{directory}/{entry_name[len(jar_prefix):]}'
+
+    return None
+
+
+def read_manifest(output_path: Path) -> dict[str, list[int]]:
+    manifest_path = output_path.joinpath(config.EXTRACT_MANIFEST_FILE)
+
+    return json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+
+def extract_entry(zip: ZipFile, entry: ZipInfo, out_file: Path) -> None:
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+
+    with zip.open(entry) as source, out_file.open('wb') as destination:
+        shutil.copyfileobj(source, destination)
+
+
+def extract_resources(jar_path: Path, output_path: Path, workers: int, force: bool = False) -> bool:
+    '''
+    Extract the resources of the jar which changed (by CRC and size) since the last extraction to output_path (all of them when
+    forced), removing the ones the jar doesn't have anymore. Returns whether anything changed.
+    '''
+    previous_manifest = read_manifest(output_path)
+    manifest = {}
+
+    with ZipFile(jar_path, 'r') as zip:
+        # a single pass over the jar's entries
+        changed = []
+        for entry in zip.infolist():
+            file_name = output_file(entry.filename)
+            if file_name is None or entry.is_dir():
+                continue
+
+            manifest[entry.filename] = [entry.CRC, entry.file_size]
+            out_file = output_path.joinpath(file_name)
+            if force or previous_manifest.get(entry.filename) != manifest[entry.filename] or not out_file.exists():
+                changed.append((entry, out_file))
+
+        # ZipFile reads are thread safe, and the decompression releases the GIL
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(lambda item: extract_entry(zip, *item), changed):
+                pass
+
+    removed = [entry_name for entry_name in previous_manifest if entry_name not in manifest]
+    for entry_name in removed:
+        output_path.joinpath(output_file(entry_name)).unlink(missing_ok=True)
+
+    output_path.mkdir(parents=True, exist_ok=True)
+    output_path.joinpath(config.EXTRACT_MANIFEST_FILE).write_text(json.dumps(manifest, separators=(',', ':')))
+
+    print(f'{len(changed)} entries extracted, {len(removed)} removed, {len(manifest) - len(changed)} unchanged')
+
+    return bool(changed or removed)
 
-base_output_path = Path(__file__).parent.joinpath('static', 'client_assets')
 
-jar_textures_path = 'assets/minecraft/textures/'
-jar_blockstates_path = 'assets/minecraft/blockstates/'
-jar_models_path = 'assets/minecraft/models/'
+if __name__ == '__main__':
+    args = ArgumentParser()
+    args.add_argument('input', type=str)
+    args.add_argument('--version', type=str, default=None,
+                      help='extract to a version sub-directory, served when the ASSETS_VERSION environment variable is set to it')
+    args.add_argument('--workers', type=int, default=config.EXTRACT_WORKERS)
+    args.add_argument('--force', action='store_true', help='extract every entry and compile the asset index again')
+    args = args.parse_args()
 
-def extract_data(zip: ZipFile, jar_prefix: str, output_path: Path):
-    for file_name in [fn for fn in zip.namelist() if fn.startswith(jar_prefix)]:
-        out_file = file_name[len(jar_prefix):].split('/')
-        out_file = output_path.joinpath(*out_file)
-        out_file.parent.mkdir(parents=True, exist_ok=True)
+    base_output_path = config.CLIENT_ASSETS_ROOT.joinpath(args.version) if args.version else config.CLIENT_ASSETS_ROOT
 
-        with zip.open(file_name) as source, out_file.open('wb') as out_file:
-            shutil.copyfileobj(source, out_file)
+    extract_resources(Path(args.input), base_output_path, args.workers, args.force)
 
-with ZipFile(args.input, 'r') as zip:
-    extract_data(zip, jar_textures_path, base_output_path.joinpath('textures'))
-    extract_data(zip, jar_blockstates_path, base_output_path.joinpath('blockstates'))
-    extract_data(zip, jar_models_path, base_output_path.joinpath('models'))
+    # The asset index (and its atlas) only needs to be compiled again when the resources changed since it was
+    if args.force or asset_index_outdated(base_output_path):
+        write_asset_index(base_output_path)
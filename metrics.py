@@ -0,0 +1,157 @@
+'''
+Stage timers and counters of the conversions. The worker processes collect their own, which are sent back with their results
+and merged into the server's totals (see /metrics) and into the metrics of the request waiting for them (see Server-Timing).
+'''
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import cProfile
+import os
+from threading import Lock
+import time
+from typing import Callable, Iterator, Optional
+
+import config
+from minecraft import resolved_models
+
+
+class Metrics:
+    def __init__(self, profile: bool = False):
+        # whether the conversions should be profiled (see config.PROFILES_PATH)
+        self.profile = profile
+        # stage name: [number of runs, total seconds]
+        self.stages: dict[str, list] = {}
+        self.counters: dict[str, int] = {}
+        # paths of the profiles written by the conversions
+        self.profiles: list[str] = []
+        self._lock = Lock()
+
+    def __getstate__(self) -> dict:
+        return {'profile': self.profile, 'stages': self.stages, 'counters': self.counters, 'profiles': self.profiles}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    def add_stage(self, name: str, seconds: float, runs: int = 1) -> None:
+        with self._lock:
+            stage = self.stages.setdefault(name, [0, 0.0])
+            stage[0] += runs
+            stage[1] += seconds
+
+    def add_count(self, name: str, value: int) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other: 'Metrics') -> None:
+        for name, (runs, seconds) in other.stages.items():
+            self.add_stage(name, seconds, runs)
+        for name, value in other.counters.items():
+            self.add_count(name, value)
+        with self._lock:
+            self.profiles.extend(other.profiles)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'stages': {name: {'runs': runs, 'seconds': seconds} for name, (runs, seconds) in self.stages.items()},
+                'counters': dict(self.counters),
+            }
+
+    def server_timing(self) -> str:
+        '''
+        The stages as a Server-Timing header value (durations in milliseconds)
+        '''
+        with self._lock:
+            return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, (_, seconds) in self.stages.items())
+
+
+# The server's totals, since it started
+totals = Metrics()
+
+# The collectors the current code reports to: the totals, plus the request's own metrics while serving one
+_collectors: ContextVar[tuple[Metrics, ...]] = ContextVar('metrics_collectors', default=(totals,))
+
+# The stage the current code runs within
+_current_stage: ContextVar[Optional[str]] = ContextVar('metrics_stage', default=None)
+
+
+@contextmanager
+def collect(*collectors: Metrics) -> Iterator[None]:
+    '''
+    Report the metrics of the code within to the given collectors instead of the current ones
+    '''
+    token = _collectors.set(collectors)
+    try:
+        yield
+    finally:
+        _collectors.reset(token)
+
+
+def profiling_requested() -> bool:
+    # the most specific collector is the request's metrics, when serving one
+    return _collectors.get()[-1].profile
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    '''
+    Time the code within. A stage running within another one is named after it, as a part of it (e.g. raw.resolve_models):
+    only the outermost stages add up to the conversion's time.
+    '''
+    outer_stage = _current_stage.get()
+    name = f'{outer_stage}.{name}' if outer_stage else name
+    token = _current_stage.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _current_stage.reset(token)
+        for collector in _collectors.get():
+            collector.add_stage(name, seconds)
+
+
+def count(name: str, value: int = 1) -> None:
+    for collector in _collectors.get():
+        collector.add_count(name, value)
+
+
+def record(worker_metrics: Metrics) -> None:
+    '''
+    Merge the metrics sent back by a worker process into the current collectors
+    '''
+    for collector in _collectors.get():
+        collector.merge(worker_metrics)
+
+
+def run_with_metrics(profile: bool, function: Callable, *args) -> tuple[object, Metrics]:
+    '''
+    Worker side: run the function, returning its result along with the metrics it collected (and its profile, if asked for)
+    '''
+    worker_metrics = Metrics()
+    hits, misses = resolved_models.hits, resolved_models.misses
+    profiler = cProfile.Profile() if profile else None
+
+    with collect(worker_metrics):
+        if profiler is not None:
+            profiler.enable()
+        try:
+            result = function(*args)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                worker_metrics.profiles.append(_dump_profile(profiler, function.__name__))
+
+    worker_metrics.add_count('model_cache_hits', resolved_models.hits - hits)
+    worker_metrics.add_count('model_cache_misses', resolved_models.misses - misses)
+
+    return result, worker_metrics
+
+
+def _dump_profile(profiler: cProfile.Profile, name: str) -> str:
+    config.PROFILES_PATH.mkdir(parents=True, exist_ok=True)
+    path = config.PROFILES_PATH.joinpath(f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{time.perf_counter_ns()}-{name}.prof')
+    profiler.dump_stats(path)
+
+    return path.name
@@ -1,8 +1,80 @@
+from copy import deepcopy
+from functools import lru_cache
+from hashlib import sha256
 import json
 from pathlib import Path
 import random
+from typing import Callable, Iterator, Optional
 
+from bounded_cache import BoundedCache
 import config
+from texture_atlas import write_texture_atlas
+
+# Bump whenever build_asset_index's output changes, so that the indexes written before are compiled again
+ASSET_INDEX_FORMAT = 1
+
+
+# Fully resolved block models, keyed by (block id, normalized block state).
+# Values are shared between callers and must never be mutated: use get_model_data to obtain a private copy.
+resolved_models: BoundedCache[tuple, tuple[dict, ...]] = BoundedCache(config.MODEL_CACHE_SIZE)
+
+
+def _strip_namespace(resource_id: str) -> str:
+    return resource_id[len('minecraft:'):] if resource_id.startswith('minecraft:') else resource_id
+
+
+def _read_asset_file(kind: str, resource_id: str) -> dict:
+    asset_path = config.CLIENT_ASSETS_PATH.joinpath(kind, f'{_strip_namespace(resource_id)}.json')
+
+    if not asset_path.exists():
+        raise Exception(f"{'Block state' if kind == 'blockstates' else 'Model'} {resource_id}'s definition was not found")
+
+    return json.loads(asset_path.read_text())
+
+
+@lru_cache(maxsize=1)
+def load_asset_index() -> Optional[dict]:
+    '''
+    Load the compiled asset index written by extract_resources.py. Without it, assets are read file by file.
+    '''
+    index_path = config.CLIENT_ASSETS_PATH.joinpath(config.ASSET_INDEX_FILE)
+
+    if not index_path.exists():
+        return None
+
+    index = json.loads(index_path.read_text())
+
+    # An index of another format can't be read: it's compiled again by the next extraction
+    return index if index.get('format') == ASSET_INDEX_FORMAT else None
+
+
+def asset_index_version() -> Optional[str]:
+    index = load_asset_index()
+
+    return index['version'] if index is not None else None
+
+
+def _split_variant_key(variant: str) -> dict[str, str]:
+    variant_values: dict[str, str] = {}
+    for prop_name, prop_val in [p.split('=') for p in variant.split(',') if len(p.split('=')) > 1]:
+        variant_values[prop_name] = prop_val
+
+    return variant_values
+
+
+def compile_block_state(raw_data: dict) -> dict:
+    '''
+    Pre-split the variant keys of a block state definition into property dicts.
+    '''
+    compiled = {}
+
+    if 'multipart' in raw_data:
+        compiled['multipart'] = raw_data['multipart']
+
+    if 'variants' in raw_data:
+        compiled['variants'] = [[_split_variant_key(variant), variant_data] for variant, variant_data in raw_data['variants'].items()]
+
+    return compiled
 
 
 def _apply_model_data(model_data: dict, result={}):
@@ -16,90 +88,266 @@ def _apply_model_data(model_data: dict, result={}):
             result[key] = val
 
 
-def _apply_model(model_id: str, result={}):
-    stripped_model_id = model_id[len('minecraft:'):] if model_id.startswith('minecraft:') else model_id
-    model_path = Path(__file__).parent \
-        .joinpath('static', 'client_assets', 'models', f'{stripped_model_id}.json')
+def _flatten_model(model_id: str, read_model: Callable[[str], dict], result: dict):
+    model_data = read_model(model_id)
+
+    if 'parent' in model_data:
+        _flatten_model(model_data['parent'], read_model, result)
+
+    _apply_model_data(model_data, result)
+
+
+@lru_cache(maxsize=config.ASSET_CACHE_SIZE)
+def _get_block_state(block_id: str) -> dict:
+    index = load_asset_index()
+    if index is None:
+        return compile_block_state(_read_asset_file('blockstates', block_id))
+
+    if _strip_namespace(block_id) not in index['blockstates']:
+        raise Exception(f"Block state {block_id}'s definition was not found")
+
+    return index['blockstates'][_strip_namespace(block_id)]
+
+
+@lru_cache(maxsize=config.ASSET_CACHE_SIZE)
+def _get_model(model_id: str) -> dict:
+    '''
+    The model with its parent chain already applied. The returned data is shared and must be treated as read-only.
+    '''
+    index = load_asset_index()
+    if index is None:
+        result = {}
+        _flatten_model(model_id, lambda parent_id: _read_asset_file('models', parent_id), result)
+        return result
 
-    if not model_path.exists():
+    if _strip_namespace(model_id) not in index['models']:
         raise Exception(f"Model {model_id}'s definition was not found")
 
-    model_data = json.loads(model_path.read_text())
+    return index['models'][_strip_namespace(model_id)]
 
-    if 'parent' in model_data:
-        _apply_model(model_data['parent'], result)
 
-    _apply_model_data(model_data, result)
+def _apply_model(model_id: str, result={}):
+    _apply_model_data(_get_model(model_id), result)
 
 
-def _process_multipart(multipart_data: list[dict], variant_data: dict, result={}):
-    for data in multipart_data:
-        if 'when' in data:
-            for key in data['when']:
-                if key in variant_data and data['when'][key] == variant_data[key] and 'apply' in data and 'model' in data['apply']:
-                    _apply_model(data['apply']['model'], result)
+WhenClause = dict[str, frozenset[str]]
 
-        elif 'apply' in data:
-            if 'model' in data['apply']:
-                _apply_model(data['apply']['model'], result)
-            _apply_model_data(data['apply'])
 
+def _and_clauses(clause: WhenClause, other_clause: WhenClause) -> WhenClause:
+    # a property constrained by both clauses must have one of the values they both accept
+    return {**clause, **{name: clause[name] & values if name in clause else values for name, values in other_clause.items()}}
 
-def get_model_data(block_id: str, variants: dict[str, str]) -> dict:
-    block_state_path = Path(__file__).parent.joinpath('static', 'client_assets',
-                                                      'blockstates', f'{block_id[len('minecraft:'):]}.json').resolve()
 
-    if not block_state_path.exists():
-        raise Exception(f"Block state {block_id}'s definition was not found")
+def _compile_when(when: dict) -> list[WhenClause]:
+    '''
+    Compile a multipart "when" condition into a decision table: the part applies when any of the clauses matches,
+    a clause matches when each of its properties has one of the listed values
+    '''
+    if 'OR' in when:
+        return [clause for condition in when['OR'] for clause in _compile_when(condition)]
+
+    if 'AND' in when:
+        clauses = [{}]
+        for condition in when['AND']:
+            clauses = [_and_clauses(clause, other_clause) for clause in clauses for other_clause in _compile_when(condition)]
+        # a property constrained to no value at all can't match
+        return [clause for clause in clauses if all(clause.values())]
+
+    # JSON booleans stand for the "true" / "false" property values
+    return [{name: frozenset((str(values).lower() if type(values) == bool else str(values)).split('|')) for name, values in when.items()}]
+
+
+class BlockStateMatcher:
+    '''
+    A block state definition compiled for lookups: the variants are hashed by the tuple of the properties their keys use,
+    the multipart conditions are compiled into decision tables
+    '''
+
+    def __init__(self, compiled_block_state: dict):
+        # property names -> {property values -> index of the first variant with these values}
+        self.variant_tables: dict[tuple[str, ...], dict[tuple[str, ...], int]] = {}
+        self.variants: list = []
+        for variant_index, (variant_values, variant_data) in enumerate(compiled_block_state.get('variants', [])):
+            names = tuple(sorted(variant_values))
+            self.variant_tables.setdefault(names, {}).setdefault(tuple(variant_values[name] for name in names), variant_index)
+            self.variants.append(variant_data)
+
+        self.has_variants = 'variants' in compiled_block_state
+        self.multipart: list[tuple[Optional[list[WhenClause]], dict]] = [
+            (_compile_when(part['when']) if 'when' in part else None, part.get('apply', {}))
+            for part in compiled_block_state.get('multipart', [])
+        ]
+
+        # only these properties change the block's model
+        self.relevant_properties = frozenset(name for names in self.variant_tables for name in names) | frozenset(
+            name for when, _ in self.multipart for clause in (when or []) for name in clause)
+
+    def find_variant(self, properties: dict[str, str]) -> Optional[dict | list]:
+        matches = []
+        for names, table in self.variant_tables.items():
+            variant_index = table.get(tuple(properties.get(name, None) for name in names), None)
+            if variant_index is not None:
+                matches.append(variant_index)
+
+        return self.variants[min(matches)] if matches else None
+
+    def matching_parts(self, properties: dict[str, str]) -> Iterator[tuple[bool, dict]]:
+        '''
+        The multipart parts applying to the block state, each with whether it's conditional
+        '''
+        for when, apply in self.multipart:
+            if when is None:
+                yield False, apply
+            elif any(all(properties.get(name, None) in values for name, values in clause.items()) for clause in when):
+                yield True, apply
+
+
+@lru_cache(maxsize=config.ASSET_CACHE_SIZE)
+def _get_block_state_matcher(block_id: str) -> BlockStateMatcher:
+    return BlockStateMatcher(_get_block_state(block_id))
+
+
+def _process_multipart(matcher: BlockStateMatcher, variant_data: dict, result={}):
+    for conditional, apply in matcher.matching_parts(variant_data):
+        if conditional:
+            if 'model' in apply:
+                _apply_model(apply['model'], result)
+
+        else:
+            if 'model' in apply:
+                _apply_model(apply['model'], result)
+            _apply_model_data(apply, result)
+
+
+def _resolve_model_data(block_id: str, variants: dict[str, str]) -> tuple[dict, ...]:
+    matcher = _get_block_state_matcher(block_id)
 
     result = {}
 
-    raw_data = json.loads(block_state_path.read_text())
     # Multipart handling (chain of responsibility pattern)
-    if 'multipart' in raw_data:
-        _process_multipart(raw_data['multipart'], variants, result)
+    if matcher.multipart:
+        _process_multipart(matcher, variants, result)
 
-    variant_data = None
+    if not matcher.has_variants:
+        return (result,)
 
-    if 'variants' in raw_data:
-        # Find the corresponding variant
-        for variant, n_variant_data in raw_data['variants'].items():
-            variant_vals = variant.split(',')
-            variant_values: dict[str, str] = {}
-            for prop_name, prop_val in [p.split('=') for p in variant_vals if len(p.split('=')) > 1]:
-                variant_values[prop_name] = prop_val
+    # Find the corresponding variant
+    variant_data = matcher.find_variant(variants)
+
+    if variant_data is None:
+        raise Exception(f"Variant {variants} was not found in block state {block_id}")
+
+    # Weighted alternatives are all resolved here, the random pick happens on each lookup
+    alternatives = []
+    for alternative in (variant_data if type(variant_data) == list else [variant_data]):
+        alternative_result = dict(result)
+        if 'model' in alternative:
+            _apply_model(alternative['model'], alternative_result)
+        _apply_model_data(alternative, alternative_result)
+        alternatives.append(alternative_result)
+
+    return tuple(alternatives)
+
+
+def _get_resolved_model_data(block_id: str, variants: dict[str, str]) -> tuple[dict, ...]:
+    # Block states only differing by properties their model doesn't depend on (e.g. waterlogged) share it
+    relevant_properties = _get_block_state_matcher(block_id).relevant_properties
+    key = (block_id, tuple(sorted(item for item in variants.items() if item[0] in relevant_properties)))
+    alternatives = resolved_models.get(key)
+
+    if alternatives is None:
+        alternatives = _resolve_model_data(block_id, variants)
+        resolved_models.put(key, alternatives)
+
+    return alternatives
+
+
+def get_model_data(block_id: str, variants: dict[str, str]) -> dict:
+    '''
+    Resolve the model of a block state. Every call returns a private copy which the caller is free to mutate.
+    '''
+    alternatives = _get_resolved_model_data(block_id, variants)
+
+    # random pick
+    return deepcopy(random.choice(alternatives) if len(alternatives) > 1 else alternatives[0])
+
+
+def is_opaque_cube(block_id: str, variants: dict[str, str]) -> bool:
+    '''
+    Whether the block state renders as a single, unrotated and opaque full cube, hiding the adjacent faces of its neighbors.
+    '''
+    if any(transparent_block in block_id for transparent_block in config.TRANSPARENT_BLOCKS):
+        return False
+
+    for model_data in _get_resolved_model_data(block_id, variants):
+        elements = model_data.get('elements', [])
+        if len(elements) != 1 or 'rotation' in elements[0]:
+            return False
 
-            filtered_variants = {key: value for key, value in variants.items() if key in variant_values}
+        element = elements[0]
+        if list(element['from']) != [0, 0, 0] or list(element['to']) != [16, 16, 16] \
+                or set(element.get('faces', {}).keys()) != {'up', 'down', 'north', 'south', 'west', 'east'}:
+            return False
 
-            if variant_values == filtered_variants:
-                variant_data = n_variant_data
-                break
+    return True
 
-        if variant_data is None:
-            raise Exception(f"Variant {variants} was not found in block state {block_id}")
 
-        # random pick
-        if type(variant_data) == list:
-            variant_data = random.choice(variant_data)
+@lru_cache(maxsize=config.ASSET_CACHE_SIZE)
+def _get_texture_url(texture_id: str) -> str:
+    index = load_asset_index()
+    if index is not None:
+        relative_path = index['textures'].get(_strip_namespace(texture_id), None)
+    else:
+        textures_path = config.CLIENT_ASSETS_PATH.joinpath('textures')
+        texture_path = textures_path.joinpath(f'{_strip_namespace(texture_id)}.png')
+        relative_path = texture_path.relative_to(textures_path).as_posix() if texture_path.exists() else None
 
-        if 'model' in variant_data:
-            _apply_model(variant_data['model'], result)
-        _apply_model_data(variant_data, result)
+    if relative_path is None:
+        raise Exception(f"Texture {texture_id}'s resourse file was not found")
 
-    return result
+    return config.TEXTURES_BASE_URL.strip('/') + '/' + relative_path
+
+
+def get_atlas_texture(texture_url: str) -> Optional[tuple[str, tuple[float, float, float, float]]]:
+    '''
+    The URL of the atlas page holding the texture, and the texture's (u0, v0, u1, v1) rect within it. None when it's not in the atlas.
+    '''
+    index = load_asset_index()
+    if index is None or 'atlas' not in index:
+        return None
+
+    base_url = config.TEXTURES_BASE_URL.strip('/') + '/'
+    atlas_texture = index['atlas']['textures'].get(texture_url[len(base_url):], None) if texture_url.startswith(base_url) else None
+    if atlas_texture is None:
+        return None
+
+    page_index, *rect = atlas_texture
+
+    return base_url + index['atlas']['pages'][page_index], tuple(rect)
+
+
+def get_block_color(block_id: str, variants: dict[str, str]) -> Optional[tuple[int, int, int]]:
+    '''
+    Average color of the textures of the block state's model, from the atlas. None when it's unknown.
+    '''
+    index = load_asset_index()
+    if index is None or 'colors' not in index.get('atlas', {}):
+        return None
+
+    textures = _get_resolved_model_data(block_id, variants)[0].get('textures', {})
+    texture_paths = [f'{_strip_namespace(texture)}.png' for key, texture in textures.items()
+                     if key != 'particle' and not texture.startswith('#')]
+    colors = [index['atlas']['colors'][texture_path] for texture_path in texture_paths if texture_path in index['atlas']['colors']]
+    if not colors:
+        return None
+
+    return tuple(int(round(sum(channel) / len(colors))) for channel in zip(*colors))
 
 
 def get_texture_urls(texture_data: dict):
     known_keys = [key for key in texture_data.keys() if texture_data[key].startswith('minecraft:')]
     for key in known_keys:
-        stripped_texture_id = texture_data[key][len('minecraft:'):] if texture_data[key].startswith('minecraft:') else texture_data[key]
-        texture_path = Path(__file__).parent.joinpath('static', 'client_assets', 'textures', f'{stripped_texture_id}.png').resolve()
-
-        if not texture_path.exists():
-            raise Exception(f"Texture {texture_data[key]}'s resourse file was not found")
-
-        texture_data[key] = config.TEXTURES_BASE_URL.strip(
-            '/') + '/' + str(texture_path.relative_to(Path(__file__).parent.joinpath('static', 'client_assets', 'textures'))).replace('\\', '/')
+        texture_data[key] = _get_texture_url(texture_data[key])
 
     keys_with_references = [key for key in texture_data.keys() if texture_data[key].startswith('#')]
     for key in known_keys:
@@ -122,3 +370,70 @@ def manage_textures_for_elements(elements: list[dict], textures: dict) -> None:
                 if not key in textures.keys():
                     raise Exception(f"Texture {key} was not found in the model's definition")
                 elem['faces'][face]['texture'] = textures[key]
+
+
+def build_asset_index(assets_path: Path) -> dict:
+    '''
+    Compile the extracted client assets into a single index: block states with pre-split variant keys,
+    models with their parent chain flattened, the texture id -> relative path table and the block textures atlas.
+    '''
+    def list_assets(kind: str, suffix: str) -> dict[str, Path]:
+        kind_path = assets_path.joinpath(kind)
+        return {path.relative_to(kind_path).with_suffix('').as_posix(): path for path in sorted(kind_path.rglob(f'*{suffix}'))}
+
+    raw_models = {model_id: json.loads(path.read_text()) for model_id, path in list_assets('models', '.json').items()}
+    models = {}
+    for model_id in raw_models:
+        result = {}
+        try:
+            _flatten_model(model_id, lambda parent_id: raw_models[_strip_namespace(parent_id)], result)
+        except KeyError:
+            # builtin parents (e.g. builtin/generated) have no definition
+            continue
+        models[model_id] = result
+
+    index = {
+        'format': ASSET_INDEX_FORMAT,
+        # the extraction the index was compiled from
+        'manifest': manifest_digest(assets_path),
+        'blockstates': {block_id: compile_block_state(json.loads(path.read_text()))
+                        for block_id, path in list_assets('blockstates', '.json').items()},
+        'models': models,
+        'textures': {texture_id: f'{texture_id}.png' for texture_id in list_assets('textures', '.png')
+                     if not texture_id.startswith(f'{config.ATLAS_DIR}/')},
+    }
+    atlas_textures = [texture_path for texture_path in index['textures'].values() if texture_path.startswith(config.ATLAS_TEXTURES)]
+    index['atlas'] = write_texture_atlas(assets_path.joinpath('textures'), atlas_textures)
+    index['version'] = sha256(json.dumps(index, sort_keys=True).encode()).hexdigest()[:16]
+
+    return index
+
+
+def manifest_digest(assets_path: Path) -> Optional[str]:
+    '''
+    Digest of the extraction manifest of the assets (see extract_resources.py), None when they weren't extracted by it
+    '''
+    manifest_path = assets_path.joinpath(config.EXTRACT_MANIFEST_FILE)
+
+    return sha256(manifest_path.read_bytes()).hexdigest()[:16] if manifest_path.exists() else None
+
+
+def asset_index_outdated(assets_path: Path) -> bool:
+    '''
+    Whether the asset index must be compiled again: it's missing, of another format, or wasn't compiled from the last
+    extraction (e.g. its compilation failed after the extraction)
+    '''
+    index_path = assets_path.joinpath(config.ASSET_INDEX_FILE)
+    if not index_path.exists():
+        return True
+
+    index = json.loads(index_path.read_text())
+
+    return index.get('format') != ASSET_INDEX_FORMAT or index.get('manifest') != manifest_digest(assets_path)
+
+
+def write_asset_index(assets_path: Path) -> Path:
+    index_path = assets_path.joinpath(config.ASSET_INDEX_FILE)
+    index_path.write_text(json.dumps(build_asset_index(assets_path), separators=(',', ':')))
+
+    return index_path
@@ -0,0 +1,97 @@
+from dataclasses import replace
+from typing import Literal
+
+import numpy as np
+
+from models.raw_models import RawBlock, RawSimplifiedBlockNoUV, RawTileEntity
+
+DIRECTION_OFFSETS: dict[Literal['up', 'down', 'north', 'south', 'west', 'east'], tuple[int, int, int]] = {
+    'up': (0, 1, 0),
+    'down': (0, -1, 0),
+    'north': (0, 0, -1),
+    'south': (0, 0, 1),
+    'west': (-1, 0, 0),
+    'east': (1, 0, 0),
+}
+
+
+def neighbor_grid(grid: np.ndarray, offset: tuple[int, int, int]) -> np.ndarray:
+    '''
+    For each cell, the value of its neighbor at the given offset (False outside of the grid)
+    '''
+    padded = np.pad(grid, 1, constant_values=False)
+
+    return padded[tuple(slice(1 + delta, 1 + delta + size) for delta, size in zip(offset, grid.shape))]
+
+
+def _faces_on_boundary(block: RawSimplifiedBlockNoUV) -> dict[str, bool]:
+    return {
+        'up': block.to_coordinate[1] == 16,
+        'down': block.from_coordinate[1] == 0,
+        'north': block.from_coordinate[2] == 0,
+        'south': block.to_coordinate[2] == 16,
+        'west': block.from_coordinate[0] == 0,
+        'east': block.to_coordinate[0] == 16,
+    }
+
+
+def _cull_block(block: RawBlock | RawSimplifiedBlockNoUV, solid_neighbors: dict[str, bool]) -> RawBlock | RawSimplifiedBlockNoUV | None:
+    # Faces of rotated geometry don't match the world directions anymore: leave them alone
+    if block.facing:
+        return block
+
+    if isinstance(block, RawSimplifiedBlockNoUV):
+        if block.transformations and block.transformations.rotation:
+            return block
+
+        # Simplified blocks don't keep the cullface data: a face is hidden when it lays on the cell's boundary
+        # and the neighbor on that side is an opaque cube
+        on_boundary = _faces_on_boundary(block)
+        hidden_faces = tuple(direction for direction in DIRECTION_OFFSETS if solid_neighbors[direction] and on_boundary[direction])
+
+        return replace(block, hidden_faces=hidden_faces) if hidden_faces else block
+
+    # Merged faces (empty key) stand for the whole element, they can't be culled
+    threed_data = []
+    for td in block.threed_data:
+        faces = {key: face for key, face in td.faces.items() if not (key and face.cullface and solid_neighbors[face.cullface])}
+        if faces:
+            threed_data.append(td if len(faces) == len(td.faces) else replace(td, faces=faces))
+
+    if not threed_data:
+        return None
+
+    return replace(block, threed_data=threed_data)
+
+
+def cull_hidden_geometry(raw_tile_entity: RawTileEntity) -> RawTileEntity:
+    '''
+    Drop the blocks fully enclosed by opaque cubes and the faces touching an opaque cube
+    '''
+    if raw_tile_entity.opaque is None or not len(raw_tile_entity.positions):
+        return raw_tile_entity
+
+    opaque = raw_tile_entity.opaque
+    grid_positions = tuple((raw_tile_entity.positions - np.array(raw_tile_entity.origin)).T)
+
+    solid_neighbors = [neighbor_grid(opaque, offset)[grid_positions] for offset in DIRECTION_OFFSETS.values()]
+    hidden = opaque[grid_positions] & np.logical_and.reduce(solid_neighbors)
+
+    # Each variant is culled once per combination of solid neighbors it's found with
+    neighbor_bits = sum(solid.astype(np.int64) << bit for bit, solid in enumerate(solid_neighbors))
+    combinations, combination_ids = np.unique(raw_tile_entity.variant_ids.astype(np.int64) * 64 + neighbor_bits, return_inverse=True)
+
+    variants = []
+    combination_variant_ids = np.full(len(combinations), -1, dtype=np.int32)
+    for i, combination in enumerate(combinations.tolist()):
+        variant_id, bits = divmod(combination, 64)
+        culled_variant = _cull_block(raw_tile_entity.variants[variant_id],
+                                     {direction: bool(bits >> bit & 1) for bit, direction in enumerate(DIRECTION_OFFSETS)})
+        if culled_variant is not None:
+            combination_variant_ids[i] = len(variants)
+            variants.append(culled_variant)
+
+    variant_ids = combination_variant_ids[combination_ids.reshape(-1)]
+    kept = ~hidden & (variant_ids >= 0)
+
+    return replace(raw_tile_entity, variants=variants, positions=raw_tile_entity.positions[kept], variant_ids=variant_ids[kept])
@@ -0,0 +1,70 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from litemapy import Region
+import numpy as np
+
+import config
+from minecraft import get_block_color
+from models.culling import DIRECTION_OFFSETS, neighbor_grid
+from models.raw_models import RawTileEntity, RegionBox, block_properties, palette_array, region_palette
+
+
+@dataclass
+class RawLodLevel:
+    # edge length, in blocks, of the level's cells
+    factor: int
+    # (n, 3) region coordinates of each visible cell's first block
+    cells: np.ndarray
+    # (n, 3) rgb color of each visible cell
+    colors: np.ndarray
+
+
+def palette_colors(region: Region) -> np.ndarray:
+    '''
+    The (palette size, 3) rgb color of the region's palette entries: their textures average color
+    '''
+    colors = np.empty((len(region_palette(region)), 3), dtype=np.float64)
+    for palette_index, block in enumerate(region_palette(region)):
+        color = None
+        if block.id != 'minecraft:air':
+            color = get_block_color(block.id, block_properties(block))
+        colors[palette_index] = color or config.LOD_DEFAULT_COLOR
+
+    return colors
+
+
+def build_lod_levels(region: Region, box: RegionBox, colors: Optional[np.ndarray] = None) -> list[RawLodLevel]:
+    '''
+    Downsample the box (in storage coordinates) to voxel grids of LOD_FACTORS blocks per cell: a cell is filled when any of its
+    blocks is, with their average color. Cells surrounded by filled cells on all sides are left out.
+    '''
+    colors = colors if colors is not None else palette_colors(region)
+    box_slices = RawTileEntity._box_slices(region, box)
+    palette_indexes = palette_array(region)[box_slices]
+    non_air_mask = ~RawTileEntity._air_palette_mask(region)[palette_indexes]
+    box_origin = np.array([region.min_x(), region.min_y(), region.min_z()]) + [box_slice.start for box_slice in box_slices]
+
+    levels = []
+    for factor in config.LOD_FACTORS:
+        # pad to whole cells, then sum each cell's blocks
+        padding = [(0, -size % factor) for size in non_air_mask.shape]
+        filled = np.pad(non_air_mask, padding, constant_values=False)
+        block_colors = np.pad(colors[palette_indexes] * non_air_mask[..., None], padding + [(0, 0)])
+
+        cells_x, cells_y, cells_z = [size // factor for size in filled.shape]
+        counts = filled.reshape(cells_x, factor, cells_y, factor, cells_z, factor).sum(axis=(1, 3, 5))
+        color_sums = block_colors.reshape(cells_x, factor, cells_y, factor, cells_z, factor, 3).sum(axis=(1, 3, 5))
+
+        occupied = counts > 0
+        hidden = occupied & np.logical_and.reduce([neighbor_grid(occupied, offset) for offset in DIRECTION_OFFSETS.values()])
+        visible = np.argwhere(occupied & ~hidden)
+        visible_cells = tuple(visible.T)
+
+        levels.append(RawLodLevel(
+            factor=factor,
+            cells=(box_origin + visible * factor).astype(np.int32),
+            colors=np.round(color_sums[visible_cells] / counts[visible_cells][:, None]).astype(np.int32),
+        ))
+
+    return levels
@@ -0,0 +1,177 @@
+from dataclasses import dataclass, replace
+from typing import Literal, Optional
+
+import numpy as np
+
+from models.culling import DIRECTION_OFFSETS
+from models.raw_models import RawBlockVariant, RawSimplifiedBlockNoUV, RawTileEntity
+
+# Texture coordinates of each face direction: (u axis, u sign, v axis, v sign), oriented as the faces of a three.js BoxGeometry
+_FACE_UV_AXES: dict[Literal['up', 'down', 'north', 'south', 'west', 'east'], tuple[int, int, int, int]] = {
+    'up': (0, 1, 2, -1),
+    'down': (0, 1, 2, 1),
+    'north': (0, -1, 1, 1),
+    'south': (0, 1, 1, 1),
+    'west': (2, 1, 1, 1),
+    'east': (2, -1, 1, 1),
+}
+
+
+@dataclass
+class RawTextureMesh:
+    texture: str
+    # (n, 3) vertices, in block corner coordinates: the block at (x, y, z) spans from (x, y, z) to (x + 1, y + 1, z + 1)
+    vertices: np.ndarray
+    # (n, 2) texture coordinates, in blocks: the texture repeats once per block
+    uvs: np.ndarray
+    # (m,) vertex indexes, three per triangle
+    indices: np.ndarray
+
+
+def _is_full_cube(from_coordinate, to_coordinate, transformations) -> bool:
+    return (tuple(from_coordinate) == (0, 0, 0) and tuple(to_coordinate) == (16, 16, 16)
+            and not (transformations and transformations.rotation))
+
+
+def cube_face_textures(block: RawBlockVariant) -> Optional[dict[str, str]]:
+    '''
+    The texture of each visible face of a full, unrotated cube. None for the blocks which can't be meshed.
+    '''
+    if block.facing or block.connected_sides:
+        return None
+
+    if isinstance(block, RawSimplifiedBlockNoUV):
+        if not _is_full_cube(block.from_coordinate, block.to_coordinate, block.transformations):
+            return None
+        return {direction: block.texture for direction in DIRECTION_OFFSETS if direction not in block.hidden_faces}
+
+    if len(block.threed_data) != 1:
+        return None
+
+    td = block.threed_data[0]
+    if not _is_full_cube(td.from_coordinate, td.to_coordinate, td.transformations) or not set(td.faces.keys()) <= set(DIRECTION_OFFSETS):
+        return None
+
+    return {direction: face.texture for direction, face in td.faces.items()}
+
+
+def _merge_faces(planes: np.ndarray, cells: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    '''
+    Cover the faces of a direction (plane, cell along the two other axes, label) with rectangles of a single label: the faces of
+    each row are merged into runs, then the runs repeated from one row to the next into rectangles.
+    Returns the rectangles as rows of (label, plane, start a, start b, end a, end b).
+    '''
+    a, b = cells[:, 0], cells[:, 1]
+
+    order = np.lexsort((b, a, planes))
+    planes, a, b, labels = planes[order], a[order], b[order], labels[order]
+    run_starts = np.ones(len(planes), dtype=bool)
+    run_starts[1:] = (planes[1:] != planes[:-1]) | (a[1:] != a[:-1]) | (b[1:] != b[:-1] + 1) | (labels[1:] != labels[:-1])
+    widths = np.diff(np.append(np.flatnonzero(run_starts), len(planes)))
+    planes, a, b, labels = planes[run_starts], a[run_starts], b[run_starts], labels[run_starts]
+
+    order = np.lexsort((a, widths, b, labels, planes))
+    planes, a, b, labels, widths = planes[order], a[order], b[order], labels[order], widths[order]
+    rectangle_starts = np.ones(len(planes), dtype=bool)
+    rectangle_starts[1:] = ((planes[1:] != planes[:-1]) | (labels[1:] != labels[:-1]) | (b[1:] != b[:-1])
+                            | (widths[1:] != widths[:-1]) | (a[1:] != a[:-1] + 1))
+    heights = np.diff(np.append(np.flatnonzero(rectangle_starts), len(planes)))
+    planes, a, b, labels, widths = (array[rectangle_starts] for array in (planes, a, b, labels, widths))
+
+    return np.stack([labels, planes, a, b, a + heights, b + widths], axis=1)
+
+
+def _build_mesh(texture: str, quads: np.ndarray) -> RawTextureMesh:
+    # quads rows: direction index, plane, then the rectangle's start and end along the two other axes (in cyclic order)
+    corners = np.array([[0, 0], [1, 0], [1, 1], [0, 1]])
+    vertices, uvs, indices = [], [], []
+
+    for direction_index, (direction, offset) in enumerate(DIRECTION_OFFSETS.items()):
+        direction_quads = quads[quads[:, 0] == direction_index]
+        if not len(direction_quads):
+            continue
+
+        axis = next(axis for axis in range(3) if offset[axis])
+        axis_a, axis_b = (axis + 1) % 3, (axis + 2) % 3
+
+        quad_vertices = np.empty((len(direction_quads), 4, 3), dtype=np.int32)
+        quad_vertices[:, :, axis] = direction_quads[:, 1:2]
+        quad_vertices[:, :, axis_a] = np.where(corners[:, 0], direction_quads[:, 4:5], direction_quads[:, 2:3])
+        quad_vertices[:, :, axis_b] = np.where(corners[:, 1], direction_quads[:, 5:6], direction_quads[:, 3:4])
+
+        u_axis, u_sign, v_axis, v_sign = _FACE_UV_AXES[direction]
+        quad_uvs = np.stack([quad_vertices[:, :, u_axis] * u_sign, quad_vertices[:, :, v_axis] * v_sign], axis=-1)
+
+        # counter-clockwise, seen from the side the face is looking at
+        triangles = np.array([0, 1, 2, 0, 2, 3] if offset[axis] > 0 else [0, 2, 1, 0, 3, 2])
+        first_quad = sum(len(direction_vertices) for direction_vertices in vertices)
+        quad_indices = triangles + 4 * (first_quad + np.arange(len(direction_quads)))[:, None]
+
+        vertices.append(quad_vertices)
+        uvs.append(quad_uvs)
+        indices.append(quad_indices)
+
+    return RawTextureMesh(
+        texture,
+        np.concatenate(vertices).reshape(-1, 3),
+        np.concatenate(uvs).astype(np.int32).reshape(-1, 2),
+        np.concatenate(indices).astype(np.int32).reshape(-1),
+    )
+
+
+def greedy_mesh(raw_tile_entity: RawTileEntity) -> tuple[RawTileEntity, list[RawTextureMesh]]:
+    '''
+    Merge the coplanar visible faces of the full cubes sharing a texture into quads, one mesh per texture.
+    Returns the remaining blocks (which are still rendered as instances) and the meshes: no meshes at all when the quads would
+    take more room than the instances they replace (e.g. noisy builds).
+    '''
+    # texture -> texture index
+    textures: dict[str, int] = {}
+    # direction -> variant id -> texture index
+    face_textures = {direction: np.full(len(raw_tile_entity.variants), -1, dtype=np.int32) for direction in DIRECTION_OFFSETS}
+    meshed_variants = np.zeros(len(raw_tile_entity.variants), dtype=bool)
+    # variant id -> number of block models each of its instances is written in (a RawBlock gets one per face)
+    variant_models = np.zeros(len(raw_tile_entity.variants), dtype=np.int64)
+
+    for variant_id, block in enumerate(raw_tile_entity.variants):
+        cube_textures = cube_face_textures(block)
+        if cube_textures is None:
+            continue
+
+        meshed_variants[variant_id] = True
+        variant_models[variant_id] = 1 if isinstance(block, RawSimplifiedBlockNoUV) else len(cube_textures)
+        for direction, texture in cube_textures.items():
+            face_textures[direction][variant_id] = textures.setdefault(texture, len(textures))
+
+    meshed = meshed_variants[raw_tile_entity.variant_ids]
+    if not meshed.any():
+        return raw_tile_entity, []
+
+    positions = raw_tile_entity.positions[meshed]
+    variant_ids = raw_tile_entity.variant_ids[meshed]
+
+    # A quad is encoded as 26 values (4 vertices, their 4 uvs and 6 indices), the instance of a block as its 3 coordinates in
+    # each of its block models
+    max_quads = int(variant_models[variant_ids].sum()) * 3 // 26
+    # rows of (label, direction index, plane, start a, start b, end a, end b)
+    quads = []
+    for direction_index, (direction, offset) in enumerate(DIRECTION_OFFSETS.items()):
+        labels = face_textures[direction][variant_ids]
+        visible = labels >= 0
+        axis = next(axis for axis in range(3) if offset[axis])
+        axis_a, axis_b = (axis + 1) % 3, (axis + 2) % 3
+
+        # faces looking towards the positive side lay on the block's far plane
+        face_planes = positions[visible, axis] + (1 if offset[axis] > 0 else 0)
+        direction_quads = _merge_faces(face_planes, positions[visible][:, [axis_a, axis_b]], labels[visible])
+        quads.append(np.insert(direction_quads, 1, direction_index, axis=1))
+
+        # the meshes wouldn't be any smaller than the instances they replace: stop right away
+        if sum(len(direction_quads) for direction_quads in quads) > max_quads:
+            return raw_tile_entity, []
+
+    quads = np.concatenate(quads)
+    meshes = [_build_mesh(texture, quads[quads[:, 0] == label, 1:]) for texture, label in textures.items() if (quads[:, 0] == label).any()]
+    remaining = replace(raw_tile_entity, positions=raw_tile_entity.positions[~meshed], variant_ids=raw_tile_entity.variant_ids[~meshed])
+
+    return remaining, meshes
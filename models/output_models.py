@@ -1,11 +1,46 @@
-from typing import Literal, Optional
-from uuid import uuid4
+from typing import Annotated, Literal, Optional
+from uuid import NAMESPACE_URL, uuid5
 
+import numpy as np
+from pydantic import PlainSerializer, PlainValidator, WithJsonSchema
 from pydantic.dataclasses import dataclass
 
+import metrics
+from minecraft import get_atlas_texture
+from models.culling import cull_hidden_geometry
+from models.lod import RawLodLevel
+from models.meshing import greedy_mesh
 from models.raw_models import RawBlock, RawBlock3DDataTransformations, RawOutputModel, RawSimplifiedBlock, RawSimplifiedBlockNoUV, RawTileEntity
 
 
+def int32_array(columns: Optional[int] = None) -> type:
+    '''
+    int32 numpy array field, of (n, columns) or (n,) shape, serialized as a list (of lists)
+    '''
+    shape = (-1, columns) if columns else (-1,)
+    item_schema = {'type': 'integer'}
+    if columns:
+        item_schema = {'type': 'array', 'items': item_schema, 'minItems': columns, 'maxItems': columns}
+
+    return Annotated[
+        np.ndarray,
+        PlainValidator(lambda value: np.asarray(value, dtype=np.int32).reshape(shape)),
+        PlainSerializer(lambda array: array.tolist()),
+        WithJsonSchema({'type': 'array', 'items': item_schema}),
+    ]
+
+
+# (n, 3) block positions, serialized as a list of [x, y, z]
+Positions = int32_array(3)
+
+_EMPTY_POSITIONS = np.empty((0, 3), dtype=np.int32)
+
+
+def texture_key(texture: str) -> str:
+    # Derived from the texture's URL, so that the same texture gets the same key on every conversion
+    return str(uuid5(NAMESPACE_URL, texture))
+
+
 @dataclass
 class BlockModel:
     from_coordinate: Optional[tuple[float, float, float]]
@@ -13,48 +48,90 @@ class BlockModel:
     texture: str
     uv: Optional[tuple[int, int, int, int]]
     face: Optional[Literal['up', 'down', 'north', 'south', 'west', 'east']]
-    positions: list[tuple[int, int, int]]
+    positions: Positions
     connected_sides: Optional[list[Literal['up', 'down', 'north', 'south', 'west', 'east']]]
     transformations: Optional[RawBlock3DDataTransformations]
+    hidden_faces: Optional[list[Literal['up', 'down', 'north', 'south', 'west', 'east']]] = None
+
+
+@dataclass
+class TextureMesh:
+    texture: str
+    # (n, 3) vertices, in block corner coordinates: the block at (x, y, z) spans from (x, y, z) to (x + 1, y + 1, z + 1)
+    vertices: int32_array(3)
+    # (n, 2) texture coordinates, in blocks: the texture repeats once per block
+    uvs: int32_array(2)
+    # vertex indexes, three per triangle
+    indices: int32_array()
+
+
+@dataclass
+class AtlasTexture:
+    # URL of the atlas page
+    page: str
+    # u0, v0, u1, v1 of the texture within the page (normalized UV coordinates)
+    rect: tuple[float, float, float, float]
 
 
 @dataclass
 class OutputRegion:
     textures: dict[str, str]
     blocks: list[BlockModel]
+    # atlas location of the textures, by texture key (textures missing from the atlas are loaded from their own URL)
+    atlas: Optional[dict[str, AtlasTexture]] = None
+    # merged full cubes faces, when meshing (see models/meshing.py)
+    meshes: Optional[list[TextureMesh]] = None
 
     @staticmethod
-    def from_raw_tile_entity(raw_tile_entity: RawTileEntity) -> 'OutputRegion':
+    def from_raw_tile_entity(raw_tile_entity: RawTileEntity, mesh: bool = False) -> 'OutputRegion':
         # used for creating the textures index
         inverted_textures: dict[str, str] = {}
 
-        # used to group blocks with the same data but different positions
-        unique_block_data: dict[str, BlockModel] = {}
+        meshes = []
+        if mesh:
+            with metrics.stage('mesh'):
+                raw_tile_entity, raw_meshes = greedy_mesh(raw_tile_entity)
+            metrics.count('meshes', len(raw_meshes))
+            for raw_mesh in raw_meshes:
+                if raw_mesh.texture not in inverted_textures.keys():
+                    inverted_textures[raw_mesh.texture] = texture_key(raw_mesh.texture)
+                meshes.append(TextureMesh(inverted_textures[raw_mesh.texture], raw_mesh.vertices, raw_mesh.uvs, raw_mesh.indices))
+
+        # used to group blocks with the same data but different positions: each group gathers the variants rendered the same way
+        unique_block_data: dict[tuple, BlockModel] = {}
+        group_variant_ids: dict[tuple, list[int]] = {}
+
+        # positions of each variant, in their original order
+        order = np.argsort(raw_tile_entity.variant_ids, kind='stable')
+        counts = np.bincount(raw_tile_entity.variant_ids, minlength=len(raw_tile_entity.variants))
+        variant_positions = np.split(raw_tile_entity.positions[order], np.cumsum(counts)[:-1])
+
+        for variant_id, block in enumerate(raw_tile_entity.variants):
+            if not counts[variant_id]:
+                continue
 
-        for block in raw_tile_entity.blocks:
             if isinstance(block, RawSimplifiedBlockNoUV):
                 # texture index
                 if block.texture not in inverted_textures.keys():
-                    inverted_textures[block.texture] = str(uuid4())
+                    inverted_textures[block.texture] = texture_key(block.texture)
 
                 # block grouping
                 uv = block.uv if type(block) == RawSimplifiedBlock else None
-                simple_dict = {'from': block.from_coordinate, 'to': block.to_coordinate,
-                               'texture': block.texture, 'uv': uv, 'facing': block.facing}
-                hashed = hash(tuple(sorted(simple_dict.items())))
-                if hashed not in unique_block_data.keys():
-                    unique_block_data[hashed] = BlockModel(
+                key = (block.from_coordinate, block.to_coordinate, block.texture, uv, block.facing, block.hidden_faces,
+                       tuple(block.connected_sides), block.transformations)
+                if key not in unique_block_data.keys():
+                    unique_block_data[key] = BlockModel(
                         from_coordinate=block.from_coordinate if block.from_coordinate != [0, 0, 0] else None,
                         to_coordinate=block.to_coordinate if block.to_coordinate != [16, 16, 16] else None,
                         texture=inverted_textures[block.texture],
                         uv=uv,
                         face=block.facing,
-                        positions=[block.position],
+                        positions=_EMPTY_POSITIONS,
                         connected_sides=block.connected_sides or None,
                         transformations=block.transformations,
+                        hidden_faces=list(block.hidden_faces) or None,
                     )
-                else:
-                    unique_block_data[hashed].positions.append(block.position)
+                group_variant_ids.setdefault(key, []).append(variant_id)
 
             elif type(block) == RawBlock:
                 # texture index
@@ -62,29 +139,77 @@ class OutputRegion:
                     faces = {block.facing: td.faces[block.facing]} if block.facing and block.facing in td.faces.keys() else td.faces
                     for direction, face in faces.items():
                         if face.texture not in inverted_textures.keys():
-                            inverted_textures[face.texture] = str(uuid4())
+                            inverted_textures[face.texture] = texture_key(face.texture)
 
-                        simple_dict = {'from': td.from_coordinate, 'to': td.to_coordinate,
-                                       'texture': face.texture, 'uv': face.uv, 'face': direction, 'transformations': td.transformations}
-                        hashed = hash(tuple(sorted(simple_dict.items())))
+                        key = (td.from_coordinate, td.to_coordinate, face.texture, face.uv, direction, td.transformations,
+                               block.facing, tuple(block.connected_sides))
 
                         # TODO: fix duplicated block positions for different facing (see duplicated torches facing all directions)
 
-                        if hashed not in unique_block_data.keys():
-                            unique_block_data[hashed] = BlockModel(
+                        if key not in unique_block_data.keys():
+                            unique_block_data[key] = BlockModel(
                                 from_coordinate=td.from_coordinate if td.from_coordinate != [0, 0, 0] else None,
                                 to_coordinate=td.to_coordinate if td.to_coordinate != [16, 16, 16] else None,
                                 texture=inverted_textures[face.texture],
                                 uv=face.uv,
                                 face=block.facing,
-                                positions=[block.position],
+                                positions=_EMPTY_POSITIONS,
                                 connected_sides=block.connected_sides or None,
                                 transformations=td.transformations,
                             )
-                        else:
-                            unique_block_data[hashed].positions.append(block.position)
+                        group_variant_ids.setdefault(key, []).append(variant_id)
+
+        for key, block_model in unique_block_data.items():
+            block_model.positions = np.concatenate([variant_positions[variant_id] for variant_id in group_variant_ids[key]])
+
+        atlas = {}
+        for texture, key in inverted_textures.items():
+            if (atlas_texture := get_atlas_texture(texture)) is not None:
+                atlas[key] = AtlasTexture(*atlas_texture)
+
+        metrics.count('block_models', len(unique_block_data))
 
-        return OutputRegion({v: k for k, v in inverted_textures.items()}, list(unique_block_data.values()))
+        return OutputRegion({v: k for k, v in inverted_textures.items()}, list(unique_block_data.values()), atlas or None, meshes or None)
+
+
+@dataclass
+class OutputChunk:
+    region: str
+    # region coordinates of the chunk's first block
+    origin: tuple[int, int, int]
+    textures: dict[str, str]
+    blocks: list[BlockModel]
+    atlas: Optional[dict[str, AtlasTexture]] = None
+    meshes: Optional[list[TextureMesh]] = None
+
+
+@dataclass
+class LodLevel:
+    # edge length, in blocks, of the level's cells
+    factor: int
+    # region coordinates of each cell's first block
+    cells: int32_array(3)
+    # rgb color of each cell
+    colors: int32_array(3)
+
+
+@dataclass
+class OutputLodChunk:
+    region: str
+    # region coordinates of the chunk's first block, the same as the chunk's OutputChunk
+    origin: tuple[int, int, int]
+    levels: list[LodLevel]
+
+    @staticmethod
+    def from_raw_lod_levels(region: str, origin: tuple[int, int, int], raw_levels: list[RawLodLevel]) -> 'OutputLodChunk':
+        return OutputLodChunk(region, origin, [LodLevel(raw_level.factor, raw_level.cells, raw_level.colors) for raw_level in raw_levels])
+
+
+@dataclass
+class OutputStreamHeader:
+    author: str
+    name: str
+    regions: list[str]
 
 
 @dataclass
@@ -94,12 +219,13 @@ class OutputModel:
     regions: dict[str, OutputRegion]
 
     @staticmethod
-    def from_raw_model(raw_model: RawOutputModel) -> 'OutputModel':
+    def from_raw_model(raw_model: RawOutputModel, cull: bool = True, mesh: bool = False) -> 'OutputModel':
         return OutputModel(
             author=raw_model.author,
             name=raw_model.name,
             regions={
-                reg: OutputRegion.from_raw_tile_entity(raw_model.regions[reg])
+                reg: OutputRegion.from_raw_tile_entity(
+                    cull_hidden_geometry(raw_model.regions[reg]) if cull else raw_model.regions[reg], mesh)
                 for reg in raw_model.regions
             },
         )
@@ -0,0 +1,86 @@
+'''
+Binary packed variant of the OutputModel, for the viewer to read the instance positions as typed arrays.
+
+Layout (little-endian):
+- 4 bytes magic (PACKED_MAGIC)
+- uint32 header length
+- JSON header, space padded to a 4 bytes boundary: the OutputModel where each BlockModel's positions are replaced
+  by {"offset": <bytes offset within the data>, "count": <number of positions>}, and each TextureMesh's vertices, uvs
+  and indices by {"offset": <bytes offset within the data>, "count": <number of rows>}
+- data, each array starting on a 4 bytes boundary: positions, mesh vertices and mesh uvs as triplets (pairs for the uvs)
+  of the header's position_type (int16 or int32), mesh indices of the header's index_type (uint16 or uint32)
+'''
+
+from dataclasses import fields
+from io import BytesIO
+import json
+import struct
+
+import numpy as np
+from pydantic_core import to_jsonable_python
+
+from models.output_models import BlockModel, OutputModel
+
+PACKED_MAGIC = b'LMVP'
+PACKED_MEDIA_TYPE = 'application/vnd.litematic-viewer.packed'
+
+_block_model_header_fields = [field.name for field in fields(BlockModel) if field.name != 'positions']
+
+
+def _fits(arrays: list[np.ndarray], dtype: type) -> bool:
+    limits = np.iinfo(dtype)
+    return all(array.size == 0 or (array.min() >= limits.min and array.max() <= limits.max) for array in arrays)
+
+
+def pack_output_model(output_model: OutputModel) -> bytes:
+    block_positions = {
+        region_name: [np.asarray(block.positions, dtype='<i4').reshape(-1, 3) for block in region.blocks]
+        for region_name, region in output_model.regions.items()
+    }
+    meshes = [mesh for region in output_model.regions.values() for mesh in region.meshes or []]
+
+    # Coordinates are packed as int16 (and indices as uint16) whenever they all fit
+    fits_int16 = _fits([positions for region_positions in block_positions.values() for positions in region_positions]
+                       + [np.asarray(getattr(mesh, name)) for mesh in meshes for name in ('vertices', 'uvs')], np.int16)
+    fits_uint16 = _fits([np.asarray(mesh.indices) for mesh in meshes], np.uint16)
+    dtype = np.dtype('<i2') if fits_int16 else np.dtype('<i4')
+    index_dtype = np.dtype('<u2') if fits_uint16 else np.dtype('<u4')
+
+    data = BytesIO()
+
+    def add_buffer(array: np.ndarray) -> dict[str, int]:
+        offset = data.tell()
+        data.write(array.tobytes())
+        data.write(b'\0' * (-data.tell() % 4))
+        return {'offset': offset, 'count': len(array)}
+
+    regions = {}
+    for region_name, region in output_model.regions.items():
+        blocks = []
+        for block, positions in zip(region.blocks, block_positions[region_name]):
+            header_fields = {name: value for name in _block_model_header_fields if (value := getattr(block, name)) is not None}
+            block_header = to_jsonable_python(header_fields, exclude_none=True)
+            block_header['positions'] = add_buffer(positions.astype(dtype, copy=False))
+            blocks.append(block_header)
+
+        regions[region_name] = {'textures': region.textures, 'blocks': blocks}
+        if region.atlas is not None:
+            regions[region_name]['atlas'] = to_jsonable_python(region.atlas)
+        if region.meshes is not None:
+            regions[region_name]['meshes'] = [{
+                'texture': mesh.texture,
+                'vertices': add_buffer(np.asarray(mesh.vertices).astype(dtype)),
+                'uvs': add_buffer(np.asarray(mesh.uvs).astype(dtype)),
+                'indices': add_buffer(np.asarray(mesh.indices).astype(index_dtype)),
+            } for mesh in region.meshes]
+
+    header = json.dumps({
+        'author': output_model.author,
+        'name': output_model.name,
+        'position_type': 'int16' if fits_int16 else 'int32',
+        'index_type': 'uint16' if fits_uint16 else 'uint32',
+        'regions': regions,
+    }, separators=(',', ':')).encode()
+    header += b' ' * (-(len(PACKED_MAGIC) + 4 + len(header)) % 4)
+
+    return b''.join([PACKED_MAGIC, struct.pack('<I', len(header)), header, data.getvalue()])
@@ -1,11 +1,38 @@
 from dataclasses import dataclass
 from functools import reduce
-from typing import Literal, Optional, Union
+from typing import Iterator, Literal, Optional, Union
 
-from litemapy import Region, Schematic
-from litemapy.storage import DiscriminatingDictionary
+from litemapy import BlockState, Region, Schematic
+import numpy as np
 
-from minecraft import get_model_data, get_texture_urls, manage_textures_for_elements
+import metrics
+from minecraft import get_model_data, get_texture_urls, is_opaque_cube, manage_textures_for_elements
+from models.tile_entities import TileEntityIndex
+
+
+# Cuboid within a region's block storage: start (inclusive) and stop (exclusive) indexes
+RegionBox = tuple[tuple[int, int, int], tuple[int, int, int]]
+
+
+# litemapy only exposes the block storage one block at a time (Region[x, y, z]), and its Region.palette compacts the palette
+# (a pass over the whole storage) on every call: the region's arrays are read directly, through these two helpers only.
+def region_palette(region: Region) -> list[BlockState]:
+    '''
+    The region's palette, as indexed by palette_array
+    '''
+    return region._Region__palette
+
+
+def palette_array(region: Region) -> np.ndarray:
+    '''
+    The region's block storage: the (width, height, length) array of palette indexes, in storage coordinates
+    '''
+    return region._Region__blocks
+
+
+def block_properties(block: BlockState) -> dict[str, str]:
+    # litemapy 0.10 has no properties accessor: they're read from the block state's NBT
+    return {str(name): str(value) for name, value in block.to_nbt().get('Properties', {}).items()}
 
 
 @dataclass
@@ -64,30 +91,29 @@ class RawBlock3DData:
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class RawBlock:
-    position: tuple[int, int, int]
     facing: Optional[Literal['up', 'down', 'north', 'south', 'west', 'east']]
     connected_sides: list[Literal['up', 'down', 'north', 'south', 'west', 'east']]
     threed_data: list[RawBlock3DData]
 
     @staticmethod
-    def get_connected_sides(props: DiscriminatingDictionary):
+    def get_connected_sides(props: dict[str, str]):
         return [prop for prop in ['up', 'down', 'north', 'south', 'west', 'east'] if props.get(prop, 'fasle') == 'true']
 
 
-@dataclass
+@dataclass(slots=True)
 class RawSimplifiedBlockNoUV:
-    position: tuple[int, int, int]
     from_coordinate: tuple[float, float, float]
     to_coordinate: tuple[float, float, float]
     facing: Literal['up', 'down', 'north', 'south', 'west', 'east', '']
     texture: str
     connected_sides: list[Literal['up', 'down', 'north', 'south', 'west', 'east']]
     transformations: Optional[RawBlock3DDataTransformations]
+    hidden_faces: tuple[Literal['up', 'down', 'north', 'south', 'west', 'east'], ...] = ()
 
 
-@dataclass
+@dataclass(slots=True)
 class RawSimplifiedBlock(RawSimplifiedBlockNoUV):
     uv: Optional[tuple[int, int, int, int]] = None
 
@@ -108,7 +134,6 @@ class RawSimplifiedBlock(RawSimplifiedBlockNoUV):
         first_face = block.threed_data[0].faces[first_face_direction]
         if first_face.uv == None:
             return RawSimplifiedBlockNoUV(
-                block.position,
                 block.threed_data[0].from_coordinate,
                 block.threed_data[0].to_coordinate,
                 block.facing,
@@ -118,83 +143,171 @@ class RawSimplifiedBlock(RawSimplifiedBlockNoUV):
             )
 
         return RawSimplifiedBlock(
-            block.position,
             block.threed_data[0].from_coordinate,
             block.threed_data[0].to_coordinate,
             block.facing,
             first_face.texture,
             block.connected_sides,
             block.threed_data[0].transformations,
-            first_face.uv,
+            uv=first_face.uv,
         )
 
 
+RawBlockVariant = RawBlock | RawSimplifiedBlock | RawSimplifiedBlockNoUV
+
+
 @dataclass
 class RawTileEntity:
-    blocks: list[RawBlock | RawBlock | RawSimplifiedBlock | RawSimplifiedBlockNoUV]
+    # interned block geometries, shared by all the positions using them
+    variants: list[RawBlockVariant]
+    # (n, 3) block positions, in region coordinates
+    positions: np.ndarray
+    # (n,) index of each position's variant
+    variant_ids: np.ndarray
+    # opaque full cubes occupancy grid, in storage coordinates
+    opaque: Optional[np.ndarray] = None
+    # region coordinates of the grid's first cell
+    origin: tuple[int, int, int] = (0, 0, 0)
+
+    @staticmethod
+    def _air_palette_mask(region: Region) -> np.ndarray:
+        return np.array([block.id == 'minecraft:air' for block in region_palette(region)])
+
+    @staticmethod
+    def _box_slices(region: Region, box: Optional[RegionBox], margin: int = 0) -> tuple[slice, slice, slice]:
+        shape = palette_array(region).shape
+        start, stop = box or ((0, 0, 0), shape)
+
+        return tuple(slice(max(0, begin - margin), min(size, end + margin)) for begin, end, size in zip(start, stop, shape))
+
+    @staticmethod
+    def iter_chunk_boxes(region: Region, chunk_size: int) -> Iterator[RegionBox]:
+        '''
+        Split the region in cubic chunks (in storage coordinates), skipping the ones made of air only
+        '''
+        non_air_mask = ~RawTileEntity._air_palette_mask(region)[palette_array(region)]
+        shape = non_air_mask.shape
+
+        for x in range(0, shape[0], chunk_size):
+            for y in range(0, shape[1], chunk_size):
+                for z in range(0, shape[2], chunk_size):
+                    if non_air_mask[x:x + chunk_size, y:y + chunk_size, z:z + chunk_size].any():
+                        yield (x, y, z), (min(x + chunk_size, shape[0]), min(y + chunk_size, shape[1]), min(z + chunk_size, shape[2]))
+
+    @staticmethod
+    def group_positions_by_palette(region: Region, box: Optional[RegionBox] = None) -> Iterator[tuple[int, BlockState, np.ndarray]]:
+        '''
+        Scan the region's palette index array (or the box within it) at once, yielding each non-air palette entry
+        (index and block state) with all its positions (in the region's coordinate system).
+        '''
+        palette = region_palette(region)
+        box_slices = RawTileEntity._box_slices(region, box)
+        palette_indexes = palette_array(region)[box_slices]
+
+        non_air_mask = ~RawTileEntity._air_palette_mask(region)[palette_indexes]
+
+        # storage coordinates (C order, same as the x -> y -> z iteration) and their palette entry
+        box_origin = [region.min_x() + box_slices[0].start, region.min_y() + box_slices[1].start, region.min_z() + box_slices[2].start]
+        coordinates = np.argwhere(non_air_mask) + np.array(box_origin)
+        coordinates_palette_indexes = palette_indexes[non_air_mask]
+
+        order = np.argsort(coordinates_palette_indexes, kind='stable')
+        unique_indexes, group_starts = np.unique(coordinates_palette_indexes[order], return_index=True)
+        for palette_index, group in zip(unique_indexes, np.split(order, group_starts[1:])):
+            yield int(palette_index), palette[palette_index], coordinates[group]
+
+    @staticmethod
+    def block_from_state(block: BlockState, positions: np.ndarray, tile_entities: TileEntityIndex) -> RawBlockVariant:
+        properties = block_properties(block)
+        with metrics.stage('resolve_models'):
+            raw_data_model = get_model_data(block.id, properties)
+        connected_sides = RawBlock.get_connected_sides(properties)
+
+        if 'elements' not in raw_data_model:
+            # search within the tile entities
+            tile_entity = tile_entities.find(block.id, positions.tolist())
+
+            if tile_entity is None:
+                raise Exception(f"Tile entity {block.id} was not found in the schematic")
+
+            # TODO: find the solution to recreate the elements somehow.
+            # For now, default to an arbitrary element (yellow wool block)
+            raw_data_model['elements'] = [{
+                'from': (0, 0, 0),
+                'to': (16, 16, 16),
+                'faces': {
+                    'down': {'uv': (16, 0, 0, 16), 'texture': '#all', 'cullface': 'down'},
+                    'up': {'uv': (16, 0, 0, 16), 'texture': '#all', 'cullface': 'up'},
+                    'north': {'uv': (16, 0, 0, 16), 'texture': '#all', 'cullface': 'north'},
+                    'south': {'uv': (16, 0, 0, 16), 'texture': '#all', 'cullface': 'south'},
+                    'west': {'uv': (16, 0, 0, 16), 'texture': '#all', 'cullface': 'west'},
+                    'east': {'uv': (16, 0, 0, 16), 'texture': '#all', 'cullface': 'east'}
+                }
+            }]
+            raw_data_model['textures'] = {'all': 'minecraft:block/yellow_wool'}
+
+        with metrics.stage('textures'):
+            if 'textures' in raw_data_model:
+                get_texture_urls(raw_data_model['textures'])
+            manage_textures_for_elements(raw_data_model['elements'], raw_data_model['textures'])
+
+        block_output = RawBlock(
+            properties.get('facing', None),
+            connected_sides,
+            [RawBlock3DData(
+                from_coordinate=tuple(datum['from']),
+                to_coordinate=tuple(datum['to']),
+                faces={
+                    key: RawFace3DData.from_dict(value)
+                    for key, value in datum['faces'].items()
+                },
+                transformations=RawBlock3DData.get_transformations_from_model_data(datum),
+            ).with_simplified_faces() for datum in raw_data_model['elements']],
+        )
+
+        return RawSimplifiedBlock.from_block(block_output)
 
     @staticmethod
-    def from_schematic_region(region: Region) -> 'RawTileEntity':
-        blocks = []
-        for x in region.range_x():
-            for y in region.range_y():
-                for z in region.range_z():
-                    block = region[x, y, z]
-
-                    if block.id == 'minecraft:air':
-                        continue
-
-                    raw_data_model = get_model_data(block.id, block._BlockState__properties)
-                    connected_sides = RawBlock.get_connected_sides(block._BlockState__properties)
-
-                    if 'elements' not in raw_data_model:
-                        # search within the tile entities
-                        tile_entity = next((te for te in region.tile_entities if str(te.data['id']) == block.id), None)
-
-                        if tile_entity is None:
-                            raise Exception(f"Tile entity {block.id} was not found in the schematic")
-
-                        # TODO: find the solution to recreate the elements somehow.
-                        # For now, default to an arbitrary element (yellow wool block)
-                        raw_data_model['elements'] = [{
-                            'from': (0, 0, 0),
-                            'to': (16, 16, 16),
-                            'faces': {
-                                'down': {'uv': (16, 0, 0, 16), 'texture': '#all', 'cullface': 'down'},
-                                'up': {'uv': (16, 0, 0, 16), 'texture': '#all', 'cullface': 'up'},
-                                'north': {'uv': (16, 0, 0, 16), 'texture': '#all', 'cullface': 'north'},
-                                'south': {'uv': (16, 0, 0, 16), 'texture': '#all', 'cullface': 'south'},
-                                'west': {'uv': (16, 0, 0, 16), 'texture': '#all', 'cullface': 'west'},
-                                'east': {'uv': (16, 0, 0, 16), 'texture': '#all', 'cullface': 'east'}
-                            }
-                        }]
-                        raw_data_model['textures'] = {'all': 'minecraft:block/yellow_wool'}
-
-                    if 'textures' in raw_data_model:
-                        get_texture_urls(raw_data_model['textures'])
-                    manage_textures_for_elements(raw_data_model['elements'], raw_data_model['textures'])
-
-                    block_output = RawBlock(
-                        (x, y, z),
-                        block._BlockState__properties.get('facing', None),
-                        connected_sides,
-                        [RawBlock3DData(
-                            from_coordinate=tuple(datum['from']),
-                            to_coordinate=tuple(datum['to']),
-                            faces={
-                                key: RawFace3DData.from_dict(value)
-                                for key, value in datum['faces'].items()
-                            },
-                            transformations=RawBlock3DData.get_transformations_from_model_data(datum),
-                        ).with_simplified_faces() for datum in raw_data_model['elements']],
-                    )
-
-                    block_output = RawSimplifiedBlock.from_block(block_output)
-
-                    blocks.append(block_output)
+    def from_schematic_region(region: Region, box: Optional[RegionBox] = None, tile_entities: Optional[TileEntityIndex] = None,
+                              outside_occludes: bool = True) -> 'RawTileEntity':
+        '''
+        Convert the whole region, or only the blocks within the box (in storage coordinates).
+        The region's tile entity index can be given, when converting it box by box.
+        outside_occludes tells whether the blocks right outside of the box hide the faces of the box's blocks (they don't when
+        they're not rendered at all).
+        '''
+        palette = region_palette(region)
+        tile_entities = tile_entities or TileEntityIndex.from_region(region)
+
+        # the model is resolved once per palette entry, as a variant shared by all of its positions
+        variants = []
+        variant_positions = []
+        for palette_index, block, positions in RawTileEntity.group_positions_by_palette(region, box):
+            variants.append(RawTileEntity.block_from_state(block, positions, tile_entities))
+            variant_positions.append(positions)
+
+        # The occupancy grid has one more cell on each side (where available), for the culling to see the box's neighbors
+        grid_slices = RawTileEntity._box_slices(region, box, margin=1 if outside_occludes else 0)
+        grid_palette_indexes = palette_array(region)[grid_slices]
+        air_palette_mask = RawTileEntity._air_palette_mask(region)
+
+        opaque_palette = np.zeros(len(palette), dtype=bool)
+        for palette_index in np.unique(grid_palette_indexes):
+            if not air_palette_mask[palette_index]:
+                opaque_palette[palette_index] = is_opaque_cube(palette[palette_index].id, block_properties(palette[palette_index]))
+
+        positions = np.concatenate(variant_positions).astype(np.int32) if variant_positions else np.empty((0, 3), dtype=np.int32)
+        box_volume = int(np.prod([box_slice.stop - box_slice.start for box_slice in RawTileEntity._box_slices(region, box)]))
+        metrics.count('blocks_scanned', box_volume)
+        metrics.count('air_skipped', box_volume - len(positions))
+        metrics.count('palette_entries', len(variants))
 
         return RawTileEntity(
-            blocks=blocks,
+            variants=variants,
+            positions=positions,
+            variant_ids=np.repeat(np.arange(len(variants), dtype=np.int32), [len(positions) for positions in variant_positions]),
+            opaque=opaque_palette[grid_palette_indexes],
+            origin=(region.min_x() + grid_slices[0].start, region.min_y() + grid_slices[1].start, region.min_z() + grid_slices[2].start),
         )
 
 
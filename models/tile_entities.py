@@ -0,0 +1,40 @@
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from litemapy import Region, TileEntity
+
+
+@dataclass
+class TileEntityIndex:
+    '''
+    Tile entities of a region, by position (in the region's coordinate system) and by id
+    '''
+    by_position: dict[tuple[int, int, int], TileEntity]
+    by_id: dict[str, list[TileEntity]]
+
+    @staticmethod
+    def from_region(region: Region) -> 'TileEntityIndex':
+        by_position = {}
+        by_id = {}
+        for tile_entity in region.tile_entities:
+            # tile entity positions are relative to the region's block storage
+            x, y, z = tile_entity.position
+            by_position[(region.min_x() + x, region.min_y() + y, region.min_z() + z)] = tile_entity
+
+            if 'id' in tile_entity.data:
+                by_id.setdefault(str(tile_entity.data['id']), []).append(tile_entity)
+
+        return TileEntityIndex(by_position, by_id)
+
+    def get(self, position: tuple[int, int, int]) -> Optional[TileEntity]:
+        return self.by_position.get(position, None)
+
+    def find(self, block_id: str, positions: Iterable[tuple[int, int, int]]) -> Optional[TileEntity]:
+        '''
+        The tile entity found at one of the positions, or else the first one with the block's id
+        '''
+        for position in positions:
+            if (tile_entity := self.by_position.get(tuple(position), None)) is not None:
+                return tile_entity
+
+        return next(iter(self.by_id.get(block_id, [])), None)
@@ -0,0 +1,147 @@
+'''
+Content addressed cache of the converted schematics: a bounded in-memory LRU backed by an on-disk store
+'''
+
+from hashlib import sha256
+import os
+from pathlib import Path
+import tempfile
+from threading import Lock
+from typing import BinaryIO, Callable, Iterable, Literal, Optional
+
+from pydantic import TypeAdapter
+
+from bounded_cache import BoundedCache
+import config
+import metrics
+from minecraft import asset_index_version
+from models.output_models import OutputModel
+from models.packed_output import PACKED_MEDIA_TYPE, pack_output_model
+
+# ndjson: the streamed conversions (see ConversionJobs.stream)
+OutputFormat = Literal['json', 'bin', 'ndjson']
+
+# Formats of the whole model conversions
+OUTPUT_MEDIA_TYPES: dict[OutputFormat, str] = {
+    'json': 'application/json',
+    'bin': PACKED_MEDIA_TYPE,
+}
+
+STREAM_MEDIA_TYPE = 'application/x-ndjson'
+
+# Bump whenever the conversion output changes, so that the cached results are not served anymore
+OUTPUT_VERSION = 6
+
+_output_model_adapter = TypeAdapter(OutputModel)
+
+
+_serializers: dict[OutputFormat, Callable[[OutputModel], bytes]] = {
+    'json': lambda output_model: _output_model_adapter.dump_json(output_model, exclude_none=True),
+    'bin': pack_output_model,
+}
+
+
+def serialize_output(output_model: OutputModel,
+                     output_formats: tuple[OutputFormat, ...] = tuple(OUTPUT_MEDIA_TYPES)) -> dict[OutputFormat, bytes]:
+    with metrics.stage('serialize'):
+        payloads = {output_format: _serializers[output_format](output_model) for output_format in output_formats}
+
+    for output_format, payload in payloads.items():
+        metrics.count(f'output_bytes_{output_format}', len(payload))
+
+    return payloads
+
+
+def content_key(data: bytes) -> str:
+    '''
+    The key of a litematic's conversion: changes with the file's content, the client assets and the options it's converted with
+    '''
+    # Without an asset index there's no assets version to rely on
+    return sha256(data + f'{asset_index_version() or "no-index"}:{OUTPUT_VERSION}:{config.GREEDY_MESHING}'.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, directory: Path, max_entries: int):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._memory: BoundedCache[tuple[str, OutputFormat], bytes] = BoundedCache(max_entries)
+        # get and put run on threads, off the event loop: guards the hits and misses
+        self._lock = Lock()
+
+    def _path(self, key: str, output_format: OutputFormat) -> Path:
+        return self.directory.joinpath(f'{key}.{output_format}')
+
+    def contains(self, key: str, output_formats: Iterable[OutputFormat] = tuple(OUTPUT_MEDIA_TYPES)) -> bool:
+        return all((key, output_format) in self._memory or self._path(key, output_format).exists() for output_format in output_formats)
+
+    def get(self, key: str, output_format: OutputFormat) -> Optional[bytes]:
+        if (payload := self._memory.get((key, output_format))) is not None:
+            with self._lock:
+                self.hits += 1
+            return payload
+
+        path = self._path(key, output_format)
+        if not path.exists():
+            with self._lock:
+                self.misses += 1
+            return None
+
+        payload = path.read_bytes()
+        with self._lock:
+            self.hits += 1
+        self._memory.put((key, output_format), payload)
+
+        return payload
+
+    def put(self, key: str, payloads: dict[OutputFormat, bytes]) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for output_format, payload in payloads.items():
+            # write then rename, so that a partially written file is never served
+            temp_path = self._path(key, output_format).with_suffix(f'.{output_format}.{os.getpid()}.tmp')
+            temp_path.write_bytes(payload)
+            temp_path.replace(self._path(key, output_format))
+
+            self._memory.put((key, output_format), payload)
+
+    def temp_file(self, key: str, output_format: OutputFormat) -> BinaryIO:
+        '''
+        A temporary file of the cache directory, for a payload written as it's produced: moved into the cache by put_file, or
+        deleted by the caller when it's not complete
+        '''
+        self.directory.mkdir(parents=True, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=self.directory, prefix=f'{key}.{output_format}.', suffix='.tmp', delete=False)
+
+    def put_file(self, key: str, output_format: OutputFormat, temp_path: Path) -> None:
+        # not kept in memory: it's read back from the disk when asked for
+        temp_path.replace(self._path(key, output_format))
+
+
+class SourceStore:
+    '''
+    On-disk store of the uploaded litematic files, by content key
+    '''
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+
+    def _path(self, key: str) -> Path:
+        return self.directory.joinpath(f'{key}.litematic')
+
+    def contains(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+
+        return path.read_bytes() if path.exists() else None
+
+    def put(self, key: str, data: bytes) -> None:
+        if self.contains(key):
+            return
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # write then rename, so that a partially written file is never read
+        temp_path = self._path(key).with_suffix(f'.litematic.{os.getpid()}.tmp')
+        temp_path.write_bytes(data)
+        temp_path.replace(self._path(key))
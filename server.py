@@ -2,25 +2,224 @@
 Provides a backend to transform the litematic format into a readable one by the frontend
 '''
 
+import asyncio
+from contextlib import asynccontextmanager
 from pathlib import Path
-from fastapi import FastAPI
+import time
+from typing import Annotated, Optional
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response, UploadFile
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from litemapy import Schematic
 
 import config
+from conversion import ConversionJob, ConversionJobs
+import metrics
+from metrics import Metrics
+from minecraft import load_asset_index
 from models.output_models import OutputModel
-from models.raw_models import RawOutputModel
+from result_cache import OUTPUT_MEDIA_TYPES, STREAM_MEDIA_TYPE, OutputFormat, ResultCache, SourceStore, content_key
+from spatial_index import SpatialQuery
 
-app = FastAPI()
+TEST_MODEL_PATH = Path(__file__).parent.joinpath('tests', 'models', 'hole_house_barebones.litematic')
+
+result_cache = ResultCache(config.RESULT_CACHE_PATH, config.RESULT_CACHE_SIZE)
+source_store = SourceStore(config.SOURCE_CACHE_PATH)
+conversion_jobs = ConversionJobs(config.CONVERSION_WORKERS, config.STREAM_WORKERS, config.MAX_CONVERSION_JOBS, result_cache)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the compiled asset index once, before serving the first conversion
+    load_asset_index()
+    conversion_jobs.start()
+    yield
+    conversion_jobs.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware('http')
+async def collect_request_metrics(request: Request, call_next) -> Response:
+    '''
+    Collect the metrics of each request on their own too, sent back as a Server-Timing header.
+    With PROFILING on, the conversions of the requests with a "profile" query parameter are profiled (see the X-Profiles header).
+    '''
+    request_metrics = Metrics(profile=config.PROFILING and 'profile' in request.query_params)
+    start = time.perf_counter()
+
+    with metrics.collect(metrics.totals, request_metrics):
+        response = await call_next(request)
+
+    request_metrics.add_stage('total', time.perf_counter() - start)
+    if config.SERVER_TIMING:
+        response.headers['Server-Timing'] = request_metrics.server_timing()
+    if request_metrics.profiles:
+        response.headers['X-Profiles'] = ', '.join(request_metrics.profiles)
+
+    return response
+
+
+@app.get('/metrics')
+async def get_metrics():
+    '''
+    The stage timers and counters of all the conversions since the server started, with the caches' statistics
+    '''
+    return {
+        **metrics.totals.snapshot(),
+        'result_cache': {'hits': result_cache.hits, 'misses': result_cache.misses},
+    }
+
+
+async def cached_result_response(request: Request, key: str, output_format: OutputFormat) -> Response:
+    etag = f'"{key}.{output_format}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+
+    if etag in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+        return Response(status_code=304, headers=headers)
+
+    # the cache reads its files off the event loop
+    payload = await asyncio.to_thread(result_cache.get, key, output_format)
+
+    return Response(payload, media_type=OUTPUT_MEDIA_TYPES[output_format], headers=headers)
+
+
+async def test_model_response(request: Request, output_format: OutputFormat) -> Response:
+    data = TEST_MODEL_PATH.read_bytes()
+    key = content_key(data)
+
+    if not result_cache.contains(key):
+        conversion_jobs.submit(data, key)
+        await conversion_jobs.wait(key)
+
+    return await get_job_result(request, key, output_format)
 
 
 @app.get('/test-model', response_model=OutputModel, response_model_exclude_none=True)
-async def test_model():
-    schematic = Schematic.load(Path(__file__).parent.joinpath('tests', 'models', 'hole_house_barebones.litematic'))
-    raw_result = RawOutputModel.from_schematic(schematic)
+async def test_model(request: Request):
+    return await test_model_response(request, 'json')
+
+
+@app.get('/test-model.bin', response_class=Response)
+async def test_model_packed(request: Request):
+    return await test_model_response(request, 'bin')
+
+
+def stream_response(data: bytes, key: str) -> StreamingResponse:
+    lines = conversion_jobs.stream(data, key, config.STREAM_CHUNK_SIZE, config.STREAM_QUEUE_SIZE)
+
+    return StreamingResponse(lines, media_type=STREAM_MEDIA_TYPE)
+
+
+@app.get('/test-model/stream', response_class=StreamingResponse)
+async def test_model_stream():
+    data = TEST_MODEL_PATH.read_bytes()
+
+    return stream_response(data, content_key(data))
+
+
+@app.post('/schematics', response_model=ConversionJob, response_model_exclude_none=True, status_code=202)
+async def upload_schematic(file: UploadFile):
+    data = await file.read()
+    key = content_key(data)
+
+    # kept for the partial conversions (see /jobs/{job_id}/query)
+    await asyncio.to_thread(source_store.put, key, data)
+
+    return conversion_jobs.submit(data, key)
+
+
+@app.post('/schematics/stream', response_class=StreamingResponse)
+async def upload_schematic_stream(file: UploadFile):
+    data = await file.read()
+    key = content_key(data)
+
+    # kept for the partial conversions (see /jobs/{job_id}/query)
+    await asyncio.to_thread(source_store.put, key, data)
+
+    return stream_response(data, key)
+
+
+async def get_job_result(request: Request, job_id: str, output_format: OutputFormat) -> Response:
+    job = conversion_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, f'Job {job_id} not found')
+    if job.status == 'failed':
+        raise HTTPException(409, f'Job {job_id} failed: {job.error}')
+    if job.status != 'done':
+        raise HTTPException(409, f'Job {job_id} is still {job.status}')
+
+    return await cached_result_response(request, job_id, output_format)
+
+
+@app.get('/jobs/{job_id}', response_model=ConversionJob, response_model_exclude_none=True)
+async def job_status(job_id: str):
+    job = conversion_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, f'Job {job_id} not found')
+
+    return job
+
+
+@app.get('/jobs/{job_id}/result', response_model=OutputModel, response_model_exclude_none=True)
+async def job_result(request: Request, job_id: str):
+    return await get_job_result(request, job_id, 'json')
+
+
+@app.get('/jobs/{job_id}/result.bin', response_class=Response)
+async def job_result_packed(request: Request, job_id: str):
+    return await get_job_result(request, job_id, 'bin')
+
+
+def spatial_query(region: Annotated[Optional[list[str]], Query()] = None,
+                  min_x: Optional[int] = None, min_y: Optional[int] = None, min_z: Optional[int] = None,
+                  max_x: Optional[int] = None, max_y: Optional[int] = None, max_z: Optional[int] = None) -> SpatialQuery:
+    '''
+    The regions to convert (all of them by default) and the inclusive bounds of the blocks to keep, in region coordinates.
+    For instance, min_y=4&max_y=4 only keeps the 4th layer.
+    '''
+    return SpatialQuery(regions=region, min_corner=(min_x, min_y, min_z), max_corner=(max_x, max_y, max_z))
+
+
+async def query_response(request: Request, key: str, data: bytes, query: SpatialQuery, output_format: OutputFormat) -> Response:
+    try:
+        result_key = await conversion_jobs.query(key, data, query)
+    except Exception as e:
+        raise HTTPException(400, f'Query failed: {e}')
+
+    return await cached_result_response(request, result_key, output_format)
+
+
+@app.get('/test-model/query', response_model=OutputModel, response_model_exclude_none=True)
+async def test_model_query(request: Request, query: Annotated[SpatialQuery, Depends(spatial_query)]):
+    data = TEST_MODEL_PATH.read_bytes()
+
+    return await query_response(request, content_key(data), data, query, 'json')
+
+
+@app.get('/test-model/query.bin', response_class=Response)
+async def test_model_query_packed(request: Request, query: Annotated[SpatialQuery, Depends(spatial_query)]):
+    data = TEST_MODEL_PATH.read_bytes()
+
+    return await query_response(request, content_key(data), data, query, 'bin')
+
+
+async def get_job_source(job_id: str) -> bytes:
+    data = await asyncio.to_thread(source_store.get, job_id)
+    if data is None:
+        raise HTTPException(404, f'Schematic {job_id} not found')
+
+    return data
+
+
+@app.get('/jobs/{job_id}/query', response_model=OutputModel, response_model_exclude_none=True)
+async def job_query(request: Request, job_id: str, query: Annotated[SpatialQuery, Depends(spatial_query)]):
+    return await query_response(request, job_id, await get_job_source(job_id), query, 'json')
+
 
-    return OutputModel.from_raw_model(raw_result)
+@app.get('/jobs/{job_id}/query.bin', response_class=Response)
+async def job_query_packed(request: Request, job_id: str, query: Annotated[SpatialQuery, Depends(spatial_query)]):
+    return await query_response(request, job_id, await get_job_source(job_id), query, 'bin')
 
 
-app.mount('/' + config.TEXTURES_BASE_URL.strip('/'), StaticFiles(directory='static/client_assets/textures'), name='textures')
+app.mount('/' + config.TEXTURES_BASE_URL.strip('/'), StaticFiles(directory=config.CLIENT_ASSETS_PATH.joinpath('textures')), name='textures')
 app.mount('/', StaticFiles(directory='static/web', html=True), name='web_resources')
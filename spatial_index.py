@@ -0,0 +1,101 @@
+'''
+Chunk grid index of the schematics, for converting only the part of a schematic a spatial query asks for
+'''
+
+from dataclasses import dataclass
+from typing import Optional
+
+from litemapy import Region, Schematic
+import numpy as np
+
+from models.raw_models import RawTileEntity, RegionBox, palette_array
+from models.tile_entities import TileEntityIndex
+
+Bounds = tuple[Optional[int], Optional[int], Optional[int]]
+
+
+@dataclass
+class SpatialQuery:
+    '''
+    Part of a schematic: the regions to convert (all of them when None) and the blocks to keep within them,
+    as inclusive bounds in region coordinates (the coordinates of the output's positions). None bounds are unbounded.
+    '''
+    regions: Optional[list[str]] = None
+    min_corner: Bounds = (None, None, None)
+    max_corner: Bounds = (None, None, None)
+
+    def cache_key(self) -> str:
+        return f'{sorted(self.regions) if self.regions is not None else None}:{self.min_corner}:{self.max_corner}'
+
+
+@dataclass
+class RegionIndex:
+    # region coordinates of the block storage's first cell
+    origin: tuple[int, int, int]
+    shape: tuple[int, int, int]
+    chunk_size: int
+    # whether each chunk of the block storage holds anything but air
+    non_empty_chunks: np.ndarray
+
+    @staticmethod
+    def from_region(region: Region, chunk_size: int) -> 'RegionIndex':
+        non_air_mask = ~RawTileEntity._air_palette_mask(region)[palette_array(region)]
+        shape = non_air_mask.shape
+
+        # pad to whole chunks, then reduce each chunk to a single cell
+        padded = np.pad(non_air_mask, [(0, -size % chunk_size) for size in shape], constant_values=False)
+        chunks_x, chunks_y, chunks_z = [size // chunk_size for size in padded.shape]
+        non_empty_chunks = padded.reshape(chunks_x, chunk_size, chunks_y, chunk_size, chunks_z, chunk_size).any(axis=(1, 3, 5))
+
+        return RegionIndex((region.min_x(), region.min_y(), region.min_z()), shape, chunk_size, non_empty_chunks)
+
+    def query_box(self, query: SpatialQuery) -> Optional[RegionBox]:
+        '''
+        The smallest box (in storage coordinates) holding all the non-air blocks within the query's bounds. None when there's none.
+        '''
+        start = [max(0, bound - origin) if bound is not None else 0 for bound, origin in zip(query.min_corner, self.origin)]
+        stop = [min(size, bound - origin + 1) if bound is not None else size
+                for bound, origin, size in zip(query.max_corner, self.origin, self.shape)]
+        if any(begin >= end for begin, end in zip(start, stop)):
+            return None
+
+        # chunks overlapping the bounds, then the non-empty ones among them
+        chunk_start = [begin // self.chunk_size for begin in start]
+        chunk_stop = [(end - 1) // self.chunk_size + 1 for end in stop]
+        non_empty = np.argwhere(self.non_empty_chunks[tuple(slice(begin, end) for begin, end in zip(chunk_start, chunk_stop))])
+        if not len(non_empty):
+            return None
+
+        first_chunk = non_empty.min(axis=0) + chunk_start
+        last_chunk = non_empty.max(axis=0) + chunk_start
+
+        return (
+            tuple(max(begin, int(chunk) * self.chunk_size) for begin, chunk in zip(start, first_chunk)),
+            tuple(min(end, (int(chunk) + 1) * self.chunk_size) for end, chunk in zip(stop, last_chunk)),
+        )
+
+
+@dataclass
+class IndexedSchematic:
+    schematic: Schematic
+    regions: dict[str, RegionIndex]
+    tile_entities: dict[str, TileEntityIndex]
+
+    @staticmethod
+    def from_schematic(schematic: Schematic, chunk_size: int) -> 'IndexedSchematic':
+        return IndexedSchematic(
+            schematic,
+            {name: RegionIndex.from_region(region, chunk_size) for name, region in schematic.regions.items()},
+            {name: TileEntityIndex.from_region(region) for name, region in schematic.regions.items()},
+        )
+
+    def query_boxes(self, query: SpatialQuery) -> dict[str, Optional[RegionBox]]:
+        '''
+        The box to convert within each of the queried regions (None for the regions with nothing to convert)
+        '''
+        region_names = query.regions if query.regions is not None else list(self.regions.keys())
+        unknown_regions = [name for name in region_names if name not in self.regions]
+        if unknown_regions:
+            raise Exception(f"Regions {', '.join(unknown_regions)} were not found in the schematic")
+
+        return {name: self.regions[name].query_box(query) for name in region_names}
@@ -8,7 +8,8 @@ document.body.appendChild(renderer.domElement);
 
 // Scene and camera creation
 const scene = new THREE.Scene();
-const camera = new THREE.PerspectiveCamera(75, window.innerWidth / window.innerHeight, 0.1, 1000);
+// The far plane leaves room for the low detail levels of large schematics
+const camera = new THREE.PerspectiveCamera(75, window.innerWidth / window.innerHeight, 0.1, 50000);
 camera.position.set(0, 30, 50);  // Position the camera at a certain distance from the blocks
 const controls = new OrbitControls(camera, renderer.domElement);
 
@@ -21,23 +22,92 @@ scene.add(light);
 const textureLoader = new THREE.TextureLoader();
 
 
-function createBlock(from, to, texturePath, uv, face, position, connectedSides, transformations) {
+// BoxGeometry's material groups order
+const boxFaces = ['east', 'west', 'up', 'down', 'south', 'north'];
+
+// Materials are shared by all the block models using the same texture
+const materials = {};
+
+function getMaterial(textureUUID, texturePath) {
+    if (!(textureUUID in materials)) {
+        const texture = textureLoader.load(texturePath);
+        materials[textureUUID] = new THREE.MeshBasicMaterial({ map: texture }); // TODO manage transparency (need more info from model) -> transparency: bool, opacity: float
+    }
+
+    return materials[textureUUID];
+}
+
+// Atlas pages are sampled without mipmaps, which would blend the neighbor textures in
+function getAtlasMaterial(pagePath) {
+    if (!(pagePath in materials)) {
+        const texture = textureLoader.load(pagePath);
+        texture.magFilter = THREE.NearestFilter;
+        texture.minFilter = THREE.NearestFilter;
+        texture.generateMipmaps = false;
+        materials[pagePath] = new THREE.MeshBasicMaterial({ map: texture });
+    }
+
+    return materials[pagePath];
+}
+
+// Merged faces span several blocks: their texture repeats once per block, within its rect of the atlas page.
+// The page's texture is shared with the other atlas materials, only the rect differs.
+function getAtlasRepeatingMaterial(pagePath, rect) {
+    const key = `${pagePath}:${rect.join(',')}`;
+    if (!(key in materials)) {
+        const material = new THREE.MeshBasicMaterial({ map: getAtlasMaterial(pagePath).map });
+        material.onBeforeCompile = shader => {
+            shader.uniforms.atlasRect = { value: new THREE.Vector4(...rect) };
+            shader.fragmentShader = 'uniform vec4 atlasRect;\n' + shader.fragmentShader.replace(
+                '#include <map_fragment>',
+                'diffuseColor *= texture2D(map, atlasRect.xy + fract(vMapUv) * (atlasRect.zw - atlasRect.xy));'
+            );
+        };
+        // a single shader program for all the rects
+        material.customProgramCacheKey = () => 'atlasRepeat';
+        materials[key] = material;
+    }
+
+    return materials[key];
+}
+
+// Textures missing from the atlas repeat on their own
+function getRepeatingMaterial(textureUUID, texturePath) {
+    const key = `${textureUUID}:repeat`;
+    if (!(key in materials)) {
+        const texture = textureLoader.load(texturePath);
+        texture.wrapS = THREE.RepeatWrapping;
+        texture.wrapT = THREE.RepeatWrapping;
+        texture.magFilter = THREE.NearestFilter;
+        materials[key] = new THREE.MeshBasicMaterial({ map: texture });
+    }
+
+    return materials[key];
+}
+
+// Moves the geometry's texture coordinates (0 to 1 over the whole texture) into the texture's rect within its atlas page
+function toAtlasUVs(geometry, rect) {
+    const uvAttribute = geometry.getAttribute('uv');
+    for (let i = 0; i < uvAttribute.count; i++) {
+        uvAttribute.setXY(
+            i,
+            rect[0] + uvAttribute.getX(i) * (rect[2] - rect[0]),
+            rect[1] + uvAttribute.getY(i) * (rect[3] - rect[1])
+        );
+    }
+    uvAttribute.needsUpdate = true;
+
+    return geometry;
+}
+
+// Geometry shared by all the instances of a block model: UVs, hidden faces, rotation and facing are baked in
+function createBlockGeometry(from, to, uv, face, transformations, hiddenFaces) {
     const geometry = new THREE.BoxGeometry(
         to[0] - from[0],
         to[1] - from[1],
         to[2] - from[2]
     );
 
-    const texture = textureLoader.load(texturePath);
-    const material = new THREE.MeshBasicMaterial({ map: texture }); // TODO manage transparency (need more info from model) -> transparency: bool, opacity: float
-
-    const block = new THREE.Mesh(geometry, material);
-    block.position.set(
-        position[0] * 16,  // Scale is based on 16x16
-        position[1] * 16,
-        position[2] * 16
-    );
-
     // Check whether there are custom UV coordinates and a specific face.
     if (face && uv) {
         // Get the UV geometry attribute
@@ -81,54 +151,38 @@ function createBlock(from, to, texturePath, uv, face, position, connectedSides,
         uvAttribute.needsUpdate = true;
     }
 
-    // Support for connected sides (for example, glass panes)
-    if (connectedSides && connectedSides.length > 0) {
-        connectedSides.forEach(side => {
-            const geometries = {
-                'north': [0.1, 16, 16],
-                'south': [0.1, 16, 16],
-                'east': [16, 16, 0.1],
-                'west': [16, 16, 0.1],
-                'up': [16, 0.1, 16],
-                'down': [16, 0.1, 16],
-            }
-            const connectionGeometry = new THREE.BoxGeometry(...geometries[side]) || null;
-            if (connectionGeometry) {
-                const connectionMesh = new THREE.Mesh(connectionGeometry, material);
-                connectionMesh.position.copy(block.position);
-                scene.add(connectionMesh);
+    // Faces hidden behind opaque neighbors are removed from the index, so they're not drawn at all
+    if (hiddenFaces) {
+        const index = geometry.getIndex().array;
+        const visibleIndex = [];
+        geometry.groups.forEach(group => {
+            if (!hiddenFaces.includes(boxFaces[group.materialIndex])) {
+                visibleIndex.push(...index.subarray(group.start, group.start + group.count));
             }
         });
+        geometry.setIndex(visibleIndex);
+        geometry.clearGroups();
     }
 
-    // Transformations support
-    if (transformations && transformations.rotation) {
-        const origin = new THREE.Vector3(
-            transformations.rotation.origin[0] * 16,
-            transformations.rotation.origin[1] * 16,
-            transformations.rotation.origin[2] * 16
-        );
+    // Every instance shares the same orientation: compute it once and apply it to the geometry
+    const orientation = new THREE.Object3D();
 
+    // Transformations support (rotation around the block's center)
+    if (transformations && transformations.rotation) {
         const angleInRadians = THREE.MathUtils.degToRad(transformations.rotation.angle);
 
-        // Move the block to the defined origin
-        block.position.sub(origin);
-
         // Rotate the block around the specified axis
         switch (transformations.rotation.axis) {
             case 'x':
-                block.rotateOnAxis(new THREE.Vector3(1, 0, 0), angleInRadians);
+                orientation.rotateOnAxis(new THREE.Vector3(1, 0, 0), angleInRadians);
                 break;
             case 'y':
-                block.rotateOnAxis(new THREE.Vector3(0, 1, 0), angleInRadians);
+                orientation.rotateOnAxis(new THREE.Vector3(0, 1, 0), angleInRadians);
                 break;
             case 'z':
-                block.rotateOnAxis(new THREE.Vector3(0, 0, 1), angleInRadians);
+                orientation.rotateOnAxis(new THREE.Vector3(0, 0, 1), angleInRadians);
                 break;
         }
-
-        // Return the block to its original position
-        block.position.add(origin);
     }
 
     // Facing management
@@ -141,42 +195,267 @@ function createBlock(from, to, texturePath, uv, face, position, connectedSides,
         }
         const orientationAngle = Math.PI * (mult[face] || 0);
 
-        block.rotation.y = orientationAngle;
-    }
-
-    return block;
-}
-
-// Sample data
-fetch('/test-model')
-    .then(response => response.json())
-    .then(data => {
-        const regions = data.regions;
-        for (const regionName in regions) {
-            const region = regions[regionName];
-            const textures = region.textures;
-            const blocks = region.blocks;
-            
-            blocks.forEach(block => {
-                const from = block.from_coordinate;
-                const to = block.to_coordinate;
-                const textureUUID = block.texture;
-                const texturePath = textures[textureUUID];
-                const uv = block.uv ?? null;
-                const face = block.face ?? null;
-                const connectedSides = block.connected_sides ?? null;
-                const transformations = block.transformations ?? null;
-                
-                block.positions.forEach(position => {
-                    const blockMesh = createBlock(from, to, texturePath, uv, face, position, connectedSides, transformations);
-                    scene.add(blockMesh);
-                });
-            });
+        orientation.rotation.y = orientationAngle;
+    }
+
+    geometry.applyQuaternion(orientation.quaternion);
+
+    return geometry;
+}
+
+// One draw call for all the positions of a block model
+function createInstancedMesh(geometry, material, positions) {
+    const count = positions.length / 3;
+    const mesh = new THREE.InstancedMesh(geometry, material, count);
+    const matrix = new THREE.Matrix4();
+
+    for (let i = 0; i < count; i++) {
+        matrix.makeTranslation(
+            positions[i * 3] * 16,  // Scale is based on 16x16
+            positions[i * 3 + 1] * 16,
+            positions[i * 3 + 2] * 16
+        );
+        mesh.setMatrixAt(i, matrix);
+    }
+    mesh.computeBoundingSphere();
+
+    return mesh;
+}
+
+// Support for connected sides (for example, glass panes)
+const connectionGeometries = {
+    'north': new THREE.BoxGeometry(0.1, 16, 16),
+    'south': new THREE.BoxGeometry(0.1, 16, 16),
+    'east': new THREE.BoxGeometry(16, 16, 0.1),
+    'west': new THREE.BoxGeometry(16, 16, 0.1),
+    'up': new THREE.BoxGeometry(16, 0.1, 16),
+    'down': new THREE.BoxGeometry(16, 0.1, 16),
+};
+
+function createBlockModel(block, textures, atlas) {
+    const from = block.from_coordinate ?? [0, 0, 0];
+    const to = block.to_coordinate ?? [16, 16, 16];
+
+    // Textures missing from the atlas are loaded on their own
+    const atlasTexture = atlas?.[block.texture];
+    const material = atlasTexture ? getAtlasMaterial(atlasTexture.page) : getMaterial(block.texture, textures[block.texture]);
+    const geometry = createBlockGeometry(from, to, block.uv ?? null, block.face ?? null, block.transformations ?? null, block.hidden_faces ?? null);
+    if (atlasTexture) {
+        toAtlasUVs(geometry, atlasTexture.rect);
+    }
+
+    const meshes = [createInstancedMesh(geometry, material, block.positions)];
+    (block.connected_sides ?? []).forEach(side => {
+        if (side in connectionGeometries) {
+            const connectionGeometry = atlasTexture ? toAtlasUVs(connectionGeometries[side].clone(), atlasTexture.rect) : connectionGeometries[side];
+            meshes.push(createInstancedMesh(connectionGeometry, material, block.positions));
         }
-        
-        animate();
     });
 
+    return meshes;
+}
+
+// Merged faces of the full cubes sharing a texture (see models/meshing.py): the vertices are block corners,
+// where a block spans 16 units centered on its position
+function createTextureMesh(mesh, textures, atlas) {
+    const geometry = new THREE.BufferGeometry();
+    geometry.setAttribute('position', new THREE.BufferAttribute(Float32Array.from(mesh.vertices, value => value * 16 - 8), 3));
+    geometry.setAttribute('uv', new THREE.BufferAttribute(Float32Array.from(mesh.uvs), 2));
+    geometry.setIndex(new THREE.BufferAttribute(mesh.indices instanceof Uint16Array ? mesh.indices : Uint32Array.from(mesh.indices), 1));
+
+    const atlasTexture = atlas?.[mesh.texture];
+    const material = atlasTexture ? getAtlasRepeatingMaterial(atlasTexture.page, atlasTexture.rect) : getRepeatingMaterial(mesh.texture, textures[mesh.texture]);
+
+    return new THREE.Mesh(geometry, material);
+}
+
+// Reads the packed output format (see models/packed_output.py): the positions of each block model
+// become a flat typed array of x, y, z triplets, sharing the response's buffer
+function parsePackedModel(buffer) {
+    const view = new DataView(buffer);
+    const magic = new TextDecoder().decode(new Uint8Array(buffer, 0, 4));
+    if (magic !== 'LMVP') {
+        throw new Error(`Unexpected packed model format: ${magic}`);
+    }
+
+    const headerLength = view.getUint32(4, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)));
+    const PositionsArray = header.position_type === 'int16' ? Int16Array : Int32Array;
+    const IndicesArray = header.index_type === 'uint16' ? Uint16Array : Uint32Array;
+    const dataOffset = 8 + headerLength;
+
+    for (const regionName in header.regions) {
+        header.regions[regionName].blocks.forEach(block => {
+            block.positions = new PositionsArray(buffer, dataOffset + block.positions.offset, block.positions.count * 3);
+        });
+        (header.regions[regionName].meshes ?? []).forEach(mesh => {
+            mesh.vertices = new PositionsArray(buffer, dataOffset + mesh.vertices.offset, mesh.vertices.count * 3);
+            mesh.uvs = new PositionsArray(buffer, dataOffset + mesh.uvs.offset, mesh.uvs.count * 2);
+            mesh.indices = new IndicesArray(buffer, dataOffset + mesh.indices.offset, mesh.indices.count);
+        });
+    }
+
+    return header;
+}
+
+function createRegionMeshes(region) {
+    const meshes = region.blocks.flatMap(block => createBlockModel(block, region.textures, region.atlas ?? null));
+    (region.meshes ?? []).forEach(mesh => meshes.push(createTextureMesh(mesh, region.textures, region.atlas ?? null)));
+
+    return meshes;
+}
+
+function addRegion(region) {
+    createRegionMeshes(region).forEach(mesh => scene.add(mesh));
+}
+
+// Camera distance (in world units) from which each low detail level is drawn, by downsampling factor
+const lodDistances = { 2: 64 * 16, 4: 128 * 16 };
+const lodMaterial = new THREE.MeshBasicMaterial();
+
+// Streamed chunks' THREE.LOD objects, by region and origin
+const chunkLods = {};
+
+function chunkKey(chunk) {
+    return `${chunk.region}:${chunk.origin.join(',')}`;
+}
+
+// One box per low detail cell, colored with the average color of its blocks
+function createLodMesh(level) {
+    const size = level.factor * 16;
+    const mesh = new THREE.InstancedMesh(new THREE.BoxGeometry(size, size, size), lodMaterial, level.cells.length);
+    const matrix = new THREE.Matrix4();
+    const color = new THREE.Color();
+
+    // A cell starts at its first block, which is centered on its position
+    const offset = (level.factor - 1) * 8;
+    level.cells.forEach(([x, y, z], i) => {
+        matrix.makeTranslation(x * 16 + offset, y * 16 + offset, z * 16 + offset);
+        mesh.setMatrixAt(i, matrix);
+        const [r, g, b] = level.colors[i];
+        mesh.setColorAt(i, color.setRGB(r / 255, g / 255, b / 255, THREE.SRGBColorSpace));
+    });
+    mesh.computeBoundingSphere();
+
+    return mesh;
+}
+
+// The low detail levels arrive first: until the chunk's detail arrives, the finest level is also drawn up close.
+// Like every mesh, the levels are skipped when their bounding sphere is outside of the camera's frustum.
+function addLodChunk(chunk) {
+    const meshes = chunk.levels.map(createLodMesh);
+    const lod = new THREE.LOD();
+
+    // THREE.LOD measures the camera's distance from its own position: center it on the chunk, keeping the meshes in place
+    if (meshes.length) {
+        lod.position.copy(meshes[0].boundingSphere.center);
+    }
+    meshes.forEach((mesh, i) => {
+        mesh.position.copy(lod.position).negate();
+        lod.addLevel(mesh, lodDistances[chunk.levels[i].factor] ?? 0);
+    });
+
+    chunkLods[chunkKey(chunk)] = lod;
+    scene.add(lod);
+}
+
+function addChunk(chunk) {
+    const lod = chunkLods[chunkKey(chunk)];
+    if (!lod) {
+        return addRegion(chunk);
+    }
+
+    const detail = new THREE.Group();
+    createRegionMeshes(chunk).forEach(mesh => detail.add(mesh));
+    detail.position.copy(lod.position).negate();
+    lod.addLevel(detail, 0);
+}
+
+function flattenPositions(region) {
+    region.blocks.forEach(block => {
+        block.positions = Int32Array.from(block.positions.flat());
+    });
+    (region.meshes ?? []).forEach(mesh => {
+        mesh.vertices = mesh.vertices.flat();
+        mesh.uvs = mesh.uvs.flat();
+    });
+    return region;
+}
+
+// Reads the NDJSON stream line by line: a header, the low detail levels of each chunk, then one converted chunk per line,
+// added to the scene as soon as it arrives
+async function streamModel(url) {
+    const response = await fetch(url);
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffered = '';
+    let isHeader = true;
+
+    const handleLine = line => {
+        if (!line.trim()) {
+            return;
+        }
+
+        const data = JSON.parse(line);
+        if (data.error) {
+            throw new Error(data.error);
+        }
+        if (isHeader) {
+            isHeader = false;
+            return;
+        }
+
+        if (data.levels) {
+            addLodChunk(data);
+        } else {
+            addChunk(flattenPositions(data));
+        }
+    };
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) {
+            break;
+        }
+
+        buffered += value;
+        const lines = buffered.split('\n');
+        buffered = lines.pop();
+        lines.forEach(handleLine);
+    }
+    handleLine(buffered);
+}
+
+// Spatial query parameters: only this part of the model is loaded (e.g. ?min_y=4&max_y=4 for a single layer)
+const queryParameters = ['region', 'min_x', 'min_y', 'min_z', 'max_x', 'max_y', 'max_z'];
+
+// Use ?format=json or ?format=bin to load the whole model at once (JSON or packed format) instead of streaming it.
+// Queried parts are always loaded at once.
+function loadModel() {
+    const parameters = new URLSearchParams(window.location.search);
+    const format = parameters.get('format');
+    const query = new URLSearchParams([...parameters].filter(([name]) => queryParameters.includes(name)));
+    const modelUrl = query.size ? '/test-model/query' : '/test-model';
+    const search = query.size ? `?${query}` : '';
+
+    if (format === 'bin') {
+        return fetch(`${modelUrl}.bin${search}`)
+            .then(response => response.arrayBuffer())
+            .then(parsePackedModel)
+            .then(data => Object.values(data.regions).forEach(addRegion));
+    }
+
+    if (format === 'json' || query.size) {
+        return fetch(`${modelUrl}${search}`)
+            .then(response => response.json())
+            .then(data => Object.values(data.regions).forEach(region => addRegion(flattenPositions(region))));
+    }
+
+    return streamModel('/test-model/stream');
+}
+
+animate();
+loadModel();
+
 // Animation function to update the rendering loop.
 function animate() {
     requestAnimationFrame(animate);
@@ -0,0 +1,62 @@
+from minecraft import BlockStateMatcher, _compile_when, compile_block_state
+
+
+def matching_models(block_state: dict, properties: dict[str, str]) -> list[str]:
+    matcher = BlockStateMatcher(compile_block_state(block_state))
+    return [apply['model'] for _, apply in matcher.matching_parts(properties)]
+
+
+def test_when_values():
+    assert _compile_when({'facing': 'north|south', 'half': 'top'}) == [
+        {'facing': frozenset({'north', 'south'}), 'half': frozenset({'top'})},
+    ]
+
+
+def test_when_booleans():
+    assert _compile_when({'up': True, 'north': False}) == [{'up': frozenset({'true'}), 'north': frozenset({'false'})}]
+
+
+def test_when_or():
+    assert _compile_when({'OR': [{'north': 'true'}, {'south': 'true', 'up': 'false'}]}) == [
+        {'north': frozenset({'true'})},
+        {'south': frozenset({'true'}), 'up': frozenset({'false'})},
+    ]
+
+
+def test_when_and():
+    assert _compile_when({'AND': [{'north': 'true'}, {'OR': [{'up': 'true'}, {'down': 'true'}]}]}) == [
+        {'north': frozenset({'true'}), 'up': frozenset({'true'})},
+        {'north': frozenset({'true'}), 'down': frozenset({'true'})},
+    ]
+
+
+def test_when_and_intersects_values():
+    assert _compile_when({'AND': [{'facing': 'north|south'}, {'facing': 'south|east'}]}) == [{'facing': frozenset({'south'})}]
+    assert _compile_when({'AND': [{'facing': 'north'}, {'facing': 'east'}]}) == []
+
+
+def test_multipart_matching():
+    block_state = {'multipart': [
+        {'apply': {'model': 'post'}},
+        {'when': {'north': True}, 'apply': {'model': 'side'}},
+        {'when': {'AND': [{'facing': 'north|south'}, {'facing': 'south|east'}]}, 'apply': {'model': 'south'}},
+        {'when': {'OR': [{'north': 'true'}, {'east': 'true'}]}, 'apply': {'model': 'any'}},
+    ]}
+
+    assert matching_models(block_state, {'north': 'false', 'facing': 'east'}) == ['post']
+    assert matching_models(block_state, {'north': 'true', 'facing': 'south'}) == ['post', 'side', 'south', 'any']
+    assert matching_models(block_state, {'east': 'true'}) == ['post', 'any']
+
+
+def test_variant_precedence():
+    # The first variant of the definition matching the block state wins, whatever the number of properties its key uses
+    variants = {'facing=north': {'model': 'north'}, 'facing=north,half=top': {'model': 'north_top'}, '': {'model': 'default'}}
+    matcher = BlockStateMatcher(compile_block_state({'variants': variants}))
+    assert matcher.find_variant({'facing': 'north', 'half': 'top'}) == {'model': 'north'}
+    assert matcher.find_variant({'facing': 'south', 'half': 'top'}) == {'model': 'default'}
+
+    variants = {'facing=north,half=top': {'model': 'north_top'}, 'facing=north': {'model': 'north'}}
+    matcher = BlockStateMatcher(compile_block_state({'variants': variants}))
+    assert matcher.find_variant({'facing': 'north', 'half': 'top'}) == {'model': 'north_top'}
+    assert matcher.find_variant({'facing': 'north', 'half': 'bottom'}) == {'model': 'north'}
+    assert matcher.find_variant({'facing': 'south', 'half': 'top'}) is None
@@ -0,0 +1,15 @@
+from bounded_cache import BoundedCache
+
+
+def test_least_recently_used_is_evicted():
+    cache = BoundedCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+
+    cache.put('c', 3)
+
+    assert 'b' not in cache
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.get('b') is None
+    assert cache.stats() == {'size': 2, 'max_size': 2, 'hits': 3, 'misses': 1}
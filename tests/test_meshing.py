@@ -0,0 +1,55 @@
+import numpy as np
+
+from models.culling import cull_hidden_geometry
+from models.meshing import greedy_mesh
+from models.raw_models import RawSimplifiedBlockNoUV, RawTileEntity
+
+
+def full_cube(texture: str) -> RawSimplifiedBlockNoUV:
+    return RawSimplifiedBlockNoUV((0, 0, 0), (16, 16, 16), '', texture, connected_sides=[], transformations=None)
+
+
+def culled_tile_entity(textures: np.ndarray) -> RawTileEntity:
+    # textures: grid of variant ids (-1: air), the opaque cubes hide the faces they touch
+    positions = np.argwhere(textures >= 0).astype(np.int32)
+    raw_tile_entity = RawTileEntity(
+        variants=[full_cube('minecraft:block/stone'), full_cube('minecraft:block/dirt')],
+        positions=positions,
+        variant_ids=textures[tuple(positions.T)].astype(np.int32),
+        opaque=textures >= 0,
+    )
+
+    return cull_hidden_geometry(raw_tile_entity)
+
+
+def test_greedy_mesh_covers_the_visible_faces():
+    textures = np.full((9, 8, 6), -1)
+    textures[:8, :7, :5] = 0
+    textures[1, 6, 4] = 1
+    textures[8, 0, 0] = 1
+    raw_tile_entity = culled_tile_entity(textures)
+    blocks = [raw_tile_entity.variants[variant_id] for variant_id in raw_tile_entity.variant_ids.tolist()]
+
+    remaining, meshes = greedy_mesh(raw_tile_entity)
+
+    assert not len(remaining.positions)
+    for texture in ('minecraft:block/stone', 'minecraft:block/dirt'):
+        visible_faces = sum(6 - len(block.hidden_faces) for block in blocks if block.texture == texture)
+        quads = np.concatenate([mesh.vertices.reshape(-1, 4, 3) for mesh in meshes if mesh.texture == texture])
+        areas = np.linalg.norm(np.cross(quads[:, 1] - quads[:, 0], quads[:, 3] - quads[:, 0]), axis=1)
+
+        assert areas.sum() == visible_faces
+
+    # two triangles per quad
+    assert sum(len(mesh.indices) // 6 for mesh in meshes) < sum(6 - len(block.hidden_faces) for block in blocks)
+
+
+def test_greedy_mesh_skips_noisy_builds():
+    # a checkerboard of two textures can't be merged at all
+    textures = np.indices((4, 4, 4)).sum(axis=0) % 2
+    raw_tile_entity = culled_tile_entity(textures)
+
+    remaining, meshes = greedy_mesh(raw_tile_entity)
+
+    assert meshes == []
+    assert len(remaining.positions) == len(raw_tile_entity.positions)
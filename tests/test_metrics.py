@@ -0,0 +1,16 @@
+import metrics
+
+
+def test_nested_stages():
+    collected = metrics.Metrics()
+    with metrics.collect(collected):
+        with metrics.stage('raw'):
+            with metrics.stage('resolve_models'):
+                pass
+            with metrics.stage('resolve_models'):
+                pass
+        with metrics.stage('cull'):
+            pass
+
+    assert {name: runs for name, (runs, _) in collected.stages.items()} == {'raw.resolve_models': 2, 'raw': 1, 'cull': 1}
+    assert collected.stages['raw'][1] >= collected.stages['raw.resolve_models'][1]
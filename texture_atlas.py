@@ -0,0 +1,113 @@
+'''
+Packs the block textures into a few atlas pages, so that the viewer loads a handful of images instead of one per texture.
+The atlas also records the average color of each texture, for the low detail versions of the schematics.
+'''
+
+from hashlib import sha256
+import json
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import config
+
+
+# Bump whenever the atlas description changes, so that the existing atlases are built again
+ATLAS_FORMAT_VERSION = 2
+
+
+def _atlas_key(textures_path: Path, texture_paths: list[str]) -> str:
+    key = sha256(f'{ATLAS_FORMAT_VERSION}:{config.ATLAS_PAGE_SIZE}:{config.ATLAS_PADDING}'.encode())
+    for texture_path in texture_paths:
+        key.update(texture_path.encode())
+        key.update(textures_path.joinpath(texture_path).read_bytes())
+
+    return key.hexdigest()[:16]
+
+
+def _load_texture(path: Path) -> Image.Image:
+    image = Image.open(path).convert('RGBA')
+
+    # Animated textures are vertical strips of square frames: keep the first one
+    if image.height > image.width:
+        image = image.crop((0, 0, image.width, image.width))
+
+    return image
+
+
+def _average_color(image: Image.Image) -> list[int]:
+    # weighted by the alpha channel, so that the transparent pixels don't count
+    pixels = np.asarray(image, dtype=np.float64).reshape(-1, 4)
+    alpha = pixels[:, 3]
+    if not alpha.sum():
+        return [0, 0, 0]
+
+    return [int(round(channel)) for channel in (pixels[:, :3] * alpha[:, None]).sum(axis=0) / alpha.sum()]
+
+
+def _paste_padded(page: Image.Image, image: Image.Image, x: int, y: int, padding: int) -> None:
+    # The texture's border pixels are repeated over the padding, so that sampling at the edges never bleeds into the neighbors
+    width, height = image.size
+    page.paste(image.resize((width + 2 * padding, height + 2 * padding), Image.Resampling.NEAREST) if padding else image, (x, y))
+    page.paste(image, (x + padding, y + padding))
+
+
+def pack_textures(textures_path: Path, texture_paths: list[str]) -> tuple[list[Image.Image], dict[str, list], dict[str, list[int]]]:
+    '''
+    Shelf-pack the textures (paths relative to textures_path) into pages of ATLAS_PAGE_SIZE pixels.
+    Returns the pages, each texture's [page index, u0, v0, u1, v1] (normalized, with v going upwards as in WebGL)
+    and each texture's average [r, g, b] color.
+    '''
+    size = config.ATLAS_PAGE_SIZE
+    padding = config.ATLAS_PADDING
+
+    images = {texture_path: _load_texture(textures_path.joinpath(texture_path)) for texture_path in texture_paths}
+    images = {texture_path: image for texture_path, image in images.items() if image.width + 2 * padding <= size}
+
+    pages: list[Image.Image] = []
+    rects: dict[str, list] = {}
+    x = y = shelf_height = size
+    for texture_path, image in sorted(images.items(), key=lambda item: (-item[1].height, -item[1].width, item[0])):
+        width, height = image.width + 2 * padding, image.height + 2 * padding
+
+        if x + width > size:
+            x, y, shelf_height = 0, y + shelf_height, height
+        if y + height > size:
+            pages.append(Image.new('RGBA', (size, size)))
+            x, y, shelf_height = 0, 0, height
+
+        _paste_padded(pages[-1], image, x, y, padding)
+        left, top = x + padding, y + padding
+        rects[texture_path] = [len(pages) - 1, left / size, 1 - (top + image.height) / size, (left + image.width) / size, 1 - top / size]
+
+        x += width
+
+    return pages, rects, {texture_path: _average_color(image) for texture_path, image in images.items()}
+
+
+def write_texture_atlas(textures_path: Path, texture_paths: list[str]) -> dict:
+    '''
+    Build the atlas of the textures (paths relative to textures_path), unless the same texture set already has one.
+    Returns its description: the pages (relative to textures_path), the rect and the average color of each texture.
+    '''
+    atlas_path = textures_path.joinpath(config.ATLAS_DIR)
+    key = _atlas_key(textures_path, texture_paths)
+    layout_path = atlas_path.joinpath(f'{key}.json')
+
+    if layout_path.exists():
+        return json.loads(layout_path.read_text())
+
+    pages, rects, colors = pack_textures(textures_path, texture_paths)
+
+    atlas_path.mkdir(parents=True, exist_ok=True)
+    page_paths = []
+    for page_index, page in enumerate(pages):
+        page_path = atlas_path.joinpath(f'{key}_{page_index}.png')
+        page.save(page_path)
+        page_paths.append(page_path.relative_to(textures_path).as_posix())
+
+    atlas = {'pages': page_paths, 'textures': rects, 'colors': colors}
+    layout_path.write_text(json.dumps(atlas, separators=(',', ':')))
+
+    return atlas